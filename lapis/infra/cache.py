@@ -0,0 +1,269 @@
+'''
+Record caches that keep resolved PID records for a limited time, so that repeated lookups do not need a request
+to the underlying infrastructure.
+'''
+import os
+import time
+import mmap
+import fcntl
+import struct
+import zlib
+import sqlite3
+import threading
+import logging
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+"""
+Default number of seconds a cached record stays valid.
+"""
+DEFAULT_TTL = 300
+
+"""
+Default maximum number of records held by a size-bounded cache.
+"""
+DEFAULT_MAX_ENTRIES = 10000
+
+"""
+Layout of shared memory cache files: a header (magic, number of slots, slot size) followed by fixed-size slots, each
+starting with a slot header (sequence number, storage time, key length, data length).
+"""
+SHM_MAGIC = "LAPISRC1"
+SHM_HEADER = struct.Struct("<8sII")
+SHM_SLOT_HEADER = struct.Struct("<IdHI")
+
+
+class RecordCache(object):
+    """
+    Abstract cache for resolved PID records.
+
+    A record cache stores the serialized form of full PID records (as delivered by the underlying infrastructure) under
+    their identifier. Infrastructures consult the cache when resolving identifiers and invalidate entries whenever
+    they modify a record. Cached records are only valid for a limited time (TTL), since modifications made by other
+    clients cannot be noticed.
+    """
+
+    def __init__(self, ttl=DEFAULT_TTL):
+        """
+        Constructor.
+
+        :param ttl: Number of seconds a stored record is considered valid.
+        """
+        self._ttl = ttl
+
+    def get(self, identifier):
+        """
+        Returns the serialized record for the given identifier.
+
+        :returns: A string or None if the record is not cached or has expired.
+        """
+        raise NotImplementedError()
+
+    def put(self, identifier, data):
+        """
+        Stores the serialized record for the given identifier, replacing any previous entry.
+
+        :param data: A string.
+        """
+        raise NotImplementedError()
+
+    def invalidate(self, identifier):
+        """
+        Removes the record of the given identifier from the cache. Does nothing if it is not cached.
+        """
+        raise NotImplementedError()
+
+    def clear(self):
+        """
+        Removes all records from the cache.
+        """
+        raise NotImplementedError()
+
+
+class DiskRecordCache(RecordCache):
+    """
+    Persistent record cache held in a single SQLite database file.
+
+    The file can be shared by any number of processes on the same machine; SQLite's file locking takes care of
+    concurrent access. The cache is bounded to a maximum number of records. If the bound is exceeded, the oldest
+    records are evicted first.
+    """
+
+    def __init__(self, path, ttl=DEFAULT_TTL, max_entries=DEFAULT_MAX_ENTRIES, timeout=30.0):
+        """
+        Constructor.
+
+        :param path: Path of the cache file. It will be created if it does not exist.
+        :param ttl: Number of seconds a stored record is considered valid.
+        :param max_entries: Maximum number of records to keep.
+        :param timeout: Number of seconds to wait for locks held by other processes.
+        """
+        super(DiskRecordCache, self).__init__(ttl)
+        self._path = path
+        self._max_entries = max_entries
+        self._timeout = timeout
+        self._lock = threading.Lock()
+        self._conn = None
+        self._conn_pid = None
+
+    def __connection(self):
+        # connections must not be shared across forked processes
+        if self._conn is None or self._conn_pid != os.getpid():
+            self._conn = sqlite3.connect(self._path, timeout=self._timeout, check_same_thread=False)
+            self._conn.execute("CREATE TABLE IF NOT EXISTS records (identifier TEXT PRIMARY KEY, data BLOB, stored REAL)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS records_stored ON records (stored)")
+            self._conn.commit()
+            self._conn_pid = os.getpid()
+        return self._conn
+
+    def get(self, identifier):
+        with self._lock:
+            conn = self.__connection()
+            row = conn.execute("SELECT data, stored FROM records WHERE identifier = ?", (identifier,)).fetchone()
+            if not row:
+                return None
+            if row[1] + self._ttl < time.time():
+                conn.execute("DELETE FROM records WHERE identifier = ?", (identifier,))
+                conn.commit()
+                return None
+            return str(row[0])
+
+    def put(self, identifier, data):
+        with self._lock:
+            conn = self.__connection()
+            conn.execute("INSERT OR REPLACE INTO records (identifier, data, stored) VALUES (?, ?, ?)",
+                         (identifier, sqlite3.Binary(data), time.time()))
+            n = conn.execute("SELECT COUNT(*) FROM records").fetchone()[0]
+            if n > self._max_entries:
+                logger.debug("Evicting %s records from disk cache %s" % (n - self._max_entries, self._path))
+                conn.execute("DELETE FROM records WHERE identifier IN (SELECT identifier FROM records ORDER BY stored LIMIT ?)",
+                             (n - self._max_entries,))
+            conn.commit()
+
+    def invalidate(self, identifier):
+        with self._lock:
+            conn = self.__connection()
+            conn.execute("DELETE FROM records WHERE identifier = ?", (identifier,))
+            conn.commit()
+
+    def clear(self):
+        with self._lock:
+            conn = self.__connection()
+            conn.execute("DELETE FROM records")
+            conn.commit()
+
+
+class SharedMemoryRecordCache(RecordCache):
+    """
+    Record cache held in a memory-mapped file, shared by all processes on a node (e.g. the workers of a pool).
+
+    The file is divided into a fixed number of equally sized slots; each identifier is mapped to one slot, so storing
+    a record evicts whatever other record occupied the slot before. Records that do not fit into a slot are not cached.
+    Reads do not take any locks: every slot carries a sequence number that writers make odd while modifying the slot,
+    and a reader discards what it has read if the sequence number was odd or changed meanwhile. Writers lock only the
+    slot they modify. Placing the file on a memory file system such as /dev/shm keeps the cache off the disk.
+    """
+
+    def __init__(self, path, ttl=DEFAULT_TTL, slots=4096, slot_size=16384):
+        """
+        Constructor. If the file already holds a cache, its number of slots and slot size take precedence over the
+        given ones.
+
+        :param path: Path of the cache file. It will be created if it does not exist.
+        :param ttl: Number of seconds a stored record is considered valid.
+        :param slots: Number of slots (i.e. maximum number of records).
+        :param slot_size: Size of a single slot in bytes, including the identifier and the slot header.
+        """
+        super(SharedMemoryRecordCache, self).__init__(ttl)
+        self._path = path
+        self._lock = threading.Lock()
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        # the header is initialized under an exclusive lock, as several processes may start at the same time
+        fcntl.lockf(self._fd, fcntl.LOCK_EX, SHM_HEADER.size, 0)
+        try:
+            header = os.read(self._fd, SHM_HEADER.size)
+            if len(header) == SHM_HEADER.size and SHM_HEADER.unpack(header)[0] == SHM_MAGIC:
+                magic, slots, slot_size = SHM_HEADER.unpack(header)
+            else:
+                os.ftruncate(self._fd, SHM_HEADER.size + slots * slot_size)
+                os.lseek(self._fd, 0, os.SEEK_SET)
+                os.write(self._fd, SHM_HEADER.pack(SHM_MAGIC, slots, slot_size))
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, SHM_HEADER.size, 0)
+        self._slots = slots
+        self._slot_size = slot_size
+        self._map = mmap.mmap(self._fd, SHM_HEADER.size + slots * slot_size)
+
+    def __slot_offset(self, key):
+        return SHM_HEADER.size + ((zlib.crc32(key) & 0xffffffff) % self._slots) * self._slot_size
+
+    @contextmanager
+    def __locked_slot(self, offset):
+        with self._lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, self._slot_size, offset)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, self._slot_size, offset)
+
+    def __read_sequence(self, offset):
+        return struct.unpack("<I", self._map[offset:offset+4])[0]
+
+    def __write_slot(self, offset, stored, key, data):
+        seq = self.__read_sequence(offset)
+        # odd sequence number: slot is being modified
+        self._map[offset:offset+4] = struct.pack("<I", (seq + 1) & 0xffffffff)
+        start = offset + SHM_SLOT_HEADER.size
+        self._map[start:start+len(key)+len(data)] = key + data
+        self._map[offset:offset+SHM_SLOT_HEADER.size] = SHM_SLOT_HEADER.pack((seq + 1) & 0xffffffff, stored, len(key), len(data))
+        self._map[offset:offset+4] = struct.pack("<I", (seq + 2) & 0xffffffff)
+
+    def get(self, identifier):
+        key = identifier.encode("utf-8")
+        offset = self.__slot_offset(key)
+        seq, stored, klen, dlen = SHM_SLOT_HEADER.unpack(self._map[offset:offset+SHM_SLOT_HEADER.size])
+        if seq & 1 or klen != len(key):
+            return None
+        start = offset + SHM_SLOT_HEADER.size
+        if self._map[start:start+klen] != key:
+            return None
+        data = self._map[start+klen:start+klen+dlen]
+        if self.__read_sequence(offset) != seq:
+            # concurrently modified
+            return None
+        if stored + self._ttl < time.time():
+            return None
+        return data
+
+    def put(self, identifier, data):
+        key = identifier.encode("utf-8")
+        if SHM_SLOT_HEADER.size + len(key) + len(data) > self._slot_size:
+            logger.debug("Record %s too large for shared memory cache slot (%s bytes)" % (identifier, len(data)))
+            self.invalidate(identifier)
+            return
+        offset = self.__slot_offset(key)
+        with self.__locked_slot(offset):
+            self.__write_slot(offset, time.time(), key, data)
+
+    def invalidate(self, identifier):
+        key = identifier.encode("utf-8")
+        offset = self.__slot_offset(key)
+        with self.__locked_slot(offset):
+            klen = SHM_SLOT_HEADER.unpack(self._map[offset:offset+SHM_SLOT_HEADER.size])[2]
+            start = offset + SHM_SLOT_HEADER.size
+            if klen == len(key) and self._map[start:start+klen] == key:
+                self.__write_slot(offset, 0, "", "")
+
+    def clear(self):
+        for i in range(self._slots):
+            offset = SHM_HEADER.size + i * self._slot_size
+            with self.__locked_slot(offset):
+                self.__write_slot(offset, 0, "", "")
+
+    def close(self):
+        """
+        Unmaps the cache file. The cache must not be used afterwards.
+        """
+        self._map.close()
+        os.close(self._fd)
@@ -76,7 +76,7 @@ class EPICInfrastructure(HandleInfrastructure):
         # must use PUT instead of POST
         pass
     
-    def _write_reference(self, identifier, key, reference):
+    def _write_reference(self, identifier, key, reference, record=None):
         # must use PUT instead of POST
         pass
     
@@ -30,10 +30,8 @@ The views and conclusions contained in the software and documentation are those
 of the authors.
 '''
 from lapis.infra.infrastructure import DOInfrastructure, PIDAlreadyExistsError, PIDAliasBrokenError
-from lapis.model.do import DigitalObject
-from lapis.model.doset import DigitalObjectSet
+from lapis.model.do import DigitalObject, intern_pid, VALUETYPE_PARENT_OBJECT, DEFAULT_WORKERS
 from lapis.model.hashmap import HandleHashmapImpl
-from lapis.model.dolist import DigitalObjectArray, DigitalObjectLinkedList
 from base64 import b64encode
 from urllib3 import HTTPSConnectionPool, disable_warnings
 import logging
@@ -58,6 +56,12 @@ The highest Handle value index for reference information
 """
 REFERENCE_INDEX_END = 1999
 
+"""
+Maximum number of references stored in a single Handle value. References of one key are spread over as many values
+as necessary.
+"""
+REFERENCE_CHUNK_SIZE = 64
+
 """
 At which Handle value index do we begin with annotation information?
 """
@@ -65,6 +69,12 @@ ANNOTATION_INDEX_START = 2000
 
 TYPE_RESOURCE_TYPE = "10876/__TYPES/RESOURCE_TYPE"
 
+"""
+Default number of connections to the Handle server kept open for reuse; one for each of the default number of workers
+of concurrent operations, so that their connections are not closed after every request.
+"""
+DEFAULT_CONNECTIONS = DEFAULT_WORKERS
+
 class IllegalHandleStructureError(Exception):
     pass
 
@@ -75,8 +85,11 @@ class HandleInfrastructure(DOInfrastructure):
     Connects to the Handle System via a RESTful interface.
     """ 
     
+    _references_in_values = True
+    
     
-    def __init__(self, host, port, user, user_index, password, path, prefix = None, additional_identifier_element = None, unsafe_ssl=False):
+    def __init__(self, host, port, user, user_index, password, path, prefix = None, additional_identifier_element = None, unsafe_ssl=False,
+                 maxsize=DEFAULT_CONNECTIONS):
         '''
         Constructor.
 
@@ -92,6 +105,9 @@ class HandleInfrastructure(DOInfrastructure):
         :param additional_identifier_element: A string that is inserted inbetween Handle prefix and suffix, e.g. if set
           to "test-", 10876/identifier becomes 10876/test-identifier.
         :unsafe_ssl: If set to True, SSL certificate warnings will be ignored. Do not activate this in productive environments!
+        :param maxsize: Number of connections kept open for reuse. Concurrent operations open additional connections if
+          all are in use, but these are closed again afterwards, so this should be at least the number of workers 
+          passed to concurrent operations.
         '''
         super(HandleInfrastructure, self).__init__()
         self._host = host
@@ -100,9 +116,9 @@ class HandleInfrastructure(DOInfrastructure):
         self._prefix = prefix
         if unsafe_ssl:
             disable_warnings()
-            self.__connpool = HTTPSConnectionPool(host, port=port, assert_hostname=False, cert_reqs="CERT_NONE")
+            self.__connpool = HTTPSConnectionPool(host, port=port, assert_hostname=False, cert_reqs="CERT_NONE", maxsize=maxsize)
         else:
-            self.__connpool = HTTPSConnectionPool(host, port=port)
+            self.__connpool = HTTPSConnectionPool(host, port=port, maxsize=maxsize)
         self.__user_handle = prefix+"/"+user
         self.__user_index = user_index
         self.__authstring = b64encode(user_index+"%3A"+user+":"+password)
@@ -110,6 +126,34 @@ class HandleInfrastructure(DOInfrastructure):
         if not self._path.endswith("/"):
             self._path = self._path + "/"
         self._additional_identifier_element = additional_identifier_element
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Factory method. Constructs an instance from a configuration laid out like ``testing-config.cfg``: section 
+        ``server`` with the options ``host``, ``port``, ``path``, ``user``, ``user_index``, ``password``, 
+        ``unsafe_ssl`` and ``connections`` (see the constructor's maxsize), and section ``handle`` with the options 
+        ``prefix`` and ``additionalelement``.
+        
+        :param config: A ConfigParser instance.
+        """
+        def option(section, name, default=None):
+            if config.has_option(section, name):
+                return config.get(section, name)
+            return default
+        port = 443
+        if config.has_option("server", "port"):
+            port = config.getint("server", "port")
+        unsafe_ssl = False
+        if config.has_option("server", "unsafe_ssl"):
+            unsafe_ssl = config.getboolean("server", "unsafe_ssl")
+        maxsize = DEFAULT_CONNECTIONS
+        if config.has_option("server", "connections"):
+            maxsize = config.getint("server", "connections")
+        return cls(config.get("server", "host"), port, option("server", "user", ""), option("server", "user_index", "300"),
+                   option("server", "password", ""), option("server", "path", "/api/handles/"), 
+                   prefix=option("handle", "prefix"), additional_identifier_element=option("handle", "additionalelement"),
+                   unsafe_ssl=unsafe_ssl, maxsize=maxsize)
             
     def _generate_random_identifier(self):
         if not self._prefix:
@@ -158,15 +202,23 @@ class HandleInfrastructure(DOInfrastructure):
         :param aliases: A list of aliases that were used to get to this identifier (may be empty). The list must be
           ordered in the order of alias resolution, i.e. aliases[0] pointed to aliases[1] etc. The last entry pointed 
           to the actual identifier. 
-        :returns: A fully fledged DigitalObject instance
+        :returns: A fully fledged DigitalObject instance, which keeps the full record as its snapshot
         """
+        from lapis.model.doset import DigitalObjectSet
+        from lapis.model.dolist import DigitalObjectArray, DigitalObjectLinkedList
         # piddata is an array of dicts, where each dict has keys: index, type, data
         references = {}
+        record = {}
         res_type = None
         if not "values" in piddata:
             raise IOError("Illegal format of JSON response from Handle server: 'values' not found in JSON record!")
-        for ele in piddata["values"]:
+        # sort by index so that reference chunks are merged in order
+        for ele in sorted(piddata["values"], key=lambda ele: int(ele["index"])):
             idx = int(ele["index"])
+            if ele["type"] == VALUETYPE_PARENT_OBJECT:
+                record[idx] = (VALUETYPE_PARENT_OBJECT, intern_pid(ele["data"]["value"]))
+            else:
+                record[idx] = (ele["type"], ele["data"]["value"])
             if idx == 2:
                 res_type = ele["data"]["value"]
                 continue
@@ -179,81 +231,51 @@ class HandleInfrastructure(DOInfrastructure):
                 list_data = json.loads(ele["data"]["value"])
                 if not isinstance(list_data, list):
                     raise IOError("Illegal format of JSON response from Handle server: Cannot load reference list! Input: %s" % ele["data"])
-                if ele["type"] not in references:
-                    references[ele["type"]] = list_data
+                list_data = [intern_pid(r) for r in list_data]
+                ref_key = intern_pid(ele["type"])
+                if ref_key not in references:
+                    references[ref_key] = list_data
                 else:
-                    references[ele["type"]].extend(list_data)
+                    references[ref_key].extend(list_data)
                 continue
         # create special instances for special resource types
         if res_type == DigitalObjectSet.RESOURCE_TYPE:
-            return DigitalObjectSet(self, identifier, references=references, alias_identifiers=aliases)
+            return DigitalObjectSet(self, identifier, references=references, alias_identifiers=aliases, record=record)
         if res_type == DigitalObjectArray.RESOURCE_TYPE:
-            return DigitalObjectArray(self, identifier, references=references, alias_identifiers=aliases)
+            return DigitalObjectArray(self, identifier, references=references, alias_identifiers=aliases, record=record)
         if res_type == DigitalObjectLinkedList.RESOURCE_TYPE:
-            return DigitalObjectLinkedList(self, identifier, references=references, alias_identifiers=aliases)
-        return DigitalObject(self, identifier, references, alias_identifiers=aliases)
+            return DigitalObjectLinkedList(self, identifier, references=references, alias_identifiers=aliases, record=record)
+        return DigitalObject(self, identifier, references, alias_identifiers=aliases, record=record)
         
     def lookup_pid(self, identifier):
         aliases = []
         while True:
             path, identifier = self._prepare_identifier(identifier)
-            resp = self.__connpool.request("GET", path, None, self.__http_headers)
-            if resp.status == 404:
-                # Handle not found
-                if len(aliases) > 0:
-                    raise PIDAliasBrokenError("Alias %s does not exist. Already resolved aliases: %s" % (identifier, aliases))
-                return None
-            elif not(200 <= resp.status <= 299):
-                raise IOError("Failed to look up Handle %s due to the following reason (HTTP Code %s): %s" % (identifier, resp.status, resp.reason))
-            else:
-                # check for HS_ALIAS redirect
-                piddata = json.loads(resp.data)
-                isa, alias_id = self._check_json_for_alias(piddata)
-                if isa:
-                    # write down alias identifier and redo lookup with target identifier
-                    aliases.append(identifier)
-                    identifier = alias_id
-                    continue                    
-                dobj = self._do_from_json(piddata, identifier, aliases)
-                return dobj            
-        
-    def _determine_index(self, identifier, handledata, key, index_start, index_end=None):
-        """
-        Finds an index in the Handle key-metadata record to store a value for the given key. If the key is already
-        present, its index will be reused. If it is not present, a free index will be determined. 
-        
-        :param identifier: The current Handle.
-        :param key: The key that will be assigned.
-        :param index_start: At which index the search should start.
-        :param index_end: Where should the search end? Use None to search all indices greater than the start index.
-        :raises: :exc:`IndexError` if all possible indices are already taken by other keys.
-        :returns: an index value. 
-        """
-        matching_values = []
-        free_index = index_start
-        taken_indices = []        
-        if not "values" in handledata:
-            raise IOError("Illegal format of JSON response from Handle server: 'values' not found in JSON record!")
-        for ele in handledata["values"]:
-            idx = int(ele["index"])
-            if (index_end and (index_start <= idx <= index_end))\
-            or (not index_end and (index_start <= idx)):
-                taken_indices.append(idx)
-            if ele["type"] == key:
-                matching_values.append(ele)
-        if len(matching_values) > 1:
-            raise IllegalHandleStructureError("Handle %s contains more than one entry of type %s!" % (identifier, key))
-        elif len(matching_values) == 1:
-            return int(matching_values[0]["index"])
-        else:
-            # key not present in Handle; must assign a new index
-            # check for free index within bounds
-            if taken_indices == []:
-                return index_start
-            m = min(taken_indices)
-            if m == index_end:
-                raise IllegalHandleStructureError("Handle %s does not have any more available index slots between %s and %s!" % (index_start, index_end))
-            return m
+            data = None
+            if self._record_cache:
+                data = self._record_cache.get(identifier)
+            if data is None:
+                resp = self.__connpool.request("GET", path, None, self.__http_headers)
+                if resp.status == 404:
+                    # Handle not found
+                    if len(aliases) > 0:
+                        raise PIDAliasBrokenError("Alias %s does not exist. Already resolved aliases: %s" % (identifier, aliases))
+                    return None
+                elif not(200 <= resp.status <= 299):
+                    raise IOError("Failed to look up Handle %s due to the following reason (HTTP Code %s): %s" % (identifier, resp.status, resp.reason))
+                data = resp.data
+                if self._record_cache:
+                    self._record_cache.put(identifier, data)
+            # check for HS_ALIAS redirect
+            piddata = json.loads(data)
+            isa, alias_id = self._check_json_for_alias(piddata)
+            if isa:
+                # write down alias identifier and redo lookup with target identifier
+                aliases.append(identifier)
+                identifier = alias_id
+                continue                    
+            dobj = self._do_from_json(piddata, identifier, aliases)
+            return dobj            
         
     def _write_pid_value(self, identifier, index, valuetype, value):
         """
@@ -264,14 +286,29 @@ class HandleInfrastructure(DOInfrastructure):
         :param valuetype: Type (arbitrary)
         :param value: Value (arbitrary)
         """
+        self._write_pid_values(identifier, {index: (valuetype, value)})
+    
+    def _write_pid_values(self, identifier, values):
+        """
+        Writes several (index, type, value) entries to the Handle with given identifier in a single request.
+        
+        :param identifier: The Handle identifier.
+        :param values: A dict with indexes (positive 32 bit ints) as keys and (type, value) tuples as values.
+        """
         path, identifier = self._prepare_identifier(identifier)
-        if type(index) is not int:
-            raise ValueError("Index must be an integer! (was: type %s, value %s)" % (type(index), index))
-        # write the raw (index, type, value) triple
-        data = json.dumps([{"index": index, "type": valuetype, "data": {"format": "string", "value": value}}])
+        handle_values = []
+        for index, (valuetype, value) in sorted(values.iteritems()):
+            if type(index) is not int:
+                raise ValueError("Index must be an integer! (was: type %s, value %s)" % (type(index), index))
+            handle_values.append({"index": index, "type": valuetype, "data": {"format": "string", "value": value}})
+        if not handle_values:
+            return
+        # write the raw (index, type, value) triples
+        data = json.dumps(handle_values)
         resp = self.__connpool.urlopen("PUT", path+"?index=various", data, self.__http_headers)
+        self._invalidate_cached_record(identifier)
         if not(200 <= resp.status <= 299):
-            raise IOError("Could not write raw value to Handle %s: %s" % (identifier, resp.reason))
+            raise IOError("Could not write raw values to Handle %s: %s" % (identifier, resp.reason))
     
     def _read_pid_value(self, identifier, index):
         """
@@ -302,28 +339,58 @@ class HandleInfrastructure(DOInfrastructure):
         """
         Removes a single Handle value at Handle of given identifier at given index.
         
+        :raises: :exc:`IOError` if no Handle with given identifier exists. 
+        """
+        self._remove_pid_values(identifier, [index])
+
+    def _remove_pid_values(self, identifier, indices):
+        """
+        Removes several Handle values at Handle of given identifier in a single request.
+        
+        :param indices: A list of indexes.
         :raises: :exc:`IOError` if no Handle with given identifier exists. 
         """
         path, identifier = self._prepare_identifier(str(identifier))
-        if type(index) is not int:
-            raise ValueError("Index must be an integer! (was: type %s, value %s)" % (type(index), index))
-        # read only the given index
-        resp = self.__connpool.urlopen("DELETE", path+"?index=%s" % index, "", self.__http_headers)
+        for index in indices:
+            if type(index) is not int:
+                raise ValueError("Index must be an integer! (was: type %s, value %s)" % (type(index), index))
+        if not indices:
+            return
+        # remove only the given indices
+        query = "&".join("index=%s" % index for index in sorted(indices))
+        resp = self.__connpool.urlopen("DELETE", path+"?"+query, "", self.__http_headers)
+        self._invalidate_cached_record(identifier)
         if not(200 <= resp.status <= 299):
-            raise IOError("Could not remove raw value from Handle %s: %s" % (identifier, resp.reason))
+            raise IOError("Could not remove raw values from Handle %s: %s" % (identifier, resp.reason))
 
     def _read_all_pid_values(self, identifier):
         """
-        Reads the full Handle record of given identifier.
+        Reads the full Handle record of given identifier. The record cache is not used, since the result is typically
+        the base of a modification.
         
         :return: a dict with indexes as keys and (type, value) tuples as values.
         """
         path, identifier = self._prepare_identifier(identifier)
-        # read full record
+        return self.__parse_values(self.__read_record_data(path, identifier))
+    
+    def _read_cached_pid_values(self, identifier):
+        if not self._record_cache:
+            return self._read_all_pid_values(identifier)
+        path, identifier = self._prepare_identifier(identifier)
+        data = self._record_cache.get(identifier)
+        if data is None:
+            data = self.__read_record_data(path, identifier)
+            self._record_cache.put(identifier, data)
+        return self.__parse_values(data)
+    
+    def __read_record_data(self, path, identifier):
         resp = self.__connpool.request("GET", path, "", self.__http_headers)
         if not(200 <= resp.status <= 299):
             raise IOError("Could not read raw values from Handle %s: %s" % (identifier, resp.reason))
-        respdata = json.loads(resp.data)
+        return resp.data
+    
+    def __parse_values(self, data):
+        respdata = json.loads(data)
         res = {}
         if not "values" in respdata:
             raise IOError("Illegal format of JSON response from Handle server: 'values' not found in JSON record!")
@@ -340,32 +407,84 @@ class HandleInfrastructure(DOInfrastructure):
             handle_values.append({"index": INDEX_RESOURCE_TYPE, "type": "", "data": {"format": "string", "value": resource_type}})
         data = json.dumps(handle_values)
         resp = self.__connpool.urlopen("PUT", path, data, self.__http_headers)
+        self._invalidate_cached_record(identifier)
         if not(200 <= resp.status <= 299):
             raise IOError("Could not write resource location to Handle %s: %s" % (identifier, resp.reason))
 
     def delete_do(self, identifier):
         path, identifier = self._prepare_identifier(identifier)
         resp = self.__connpool.urlopen("DELETE", path, headers=self.__http_headers)
+        self._invalidate_cached_record(identifier)
         if resp.status == 404:
             raise KeyError("Handle not found: %s" % identifier)
         if not(200 <= resp.status <= 299):
             raise IOError("Could not delete Handle %s: %s" % (identifier, resp.reason))
 
-    def _write_reference(self, identifier, key, reference):
-        path, identifier = self._prepare_identifier(identifier)
-        # first, we need to determine the index to use by looking at the key
-        resp = self.__connpool.request("GET", path, headers=self.__http_headers)
-        if not(200 <= resp.status <= 299):
-            raise IOError("Unknown Handle: %s" % identifier)
-        dodata = json.loads(resp.data)
-        index = self._determine_index(identifier, dodata, key, REFERENCE_INDEX_START, REFERENCE_INDEX_END)
-        # now we can write the reference; note that reference may be a list. But this is okay, we
-        # convert it to a string and take care of reconversion in the JSON-to-DO method
-        reference_s = json.dumps(reference)
-        data = json.dumps({"values": [{"index": index, "type": key, "data": {"format": "string", "value": reference_s}}]})
-        resp = self.__connpool.urlopen("PUT", path+"?index=various", data, self.__http_headers)
-        if not(200 <= resp.status <= 299):
-            raise IOError("Could not write references to Handle %s: %s" % (identifier, resp.reason))
+    def __read_reference_values(self, identifier, record):
+        if record is None:
+            record = self._read_pid_value_range(identifier, REFERENCE_INDEX_START, REFERENCE_INDEX_END+1)
+        return record
+    
+    def __reference_indices(self, record, key):
+        return sorted(idx for idx, v in record.iteritems() if REFERENCE_INDEX_START <= idx <= REFERENCE_INDEX_END and v[0] == key)
+    
+    def __free_reference_indices(self, identifier, record, n, above=REFERENCE_INDEX_START-1):
+        # new chunks of a key must be placed above its existing ones to keep the chunks in order
+        free = []
+        for idx in xrange(above+1, REFERENCE_INDEX_END+1):
+            if len(free) == n:
+                break
+            if idx not in record:
+                free.append(idx)
+        if len(free) < n:
+            raise IllegalHandleStructureError("Handle %s does not have any more available index slots between %s and %s!" % (identifier, REFERENCE_INDEX_START, REFERENCE_INDEX_END))
+        return free
+    
+    def _write_reference(self, identifier, key, reference, record=None):
+        # references are stored as JSON lists in chunks of limited size, each chunk in a separate value of the key's
+        # type; chunks are ordered by index and all but the last one are full
+        record = self.__read_reference_values(identifier, record)
+        indices = self.__reference_indices(record, key)
+        chunks = [reference[i:i+REFERENCE_CHUNK_SIZE] for i in range(0, len(reference), REFERENCE_CHUNK_SIZE)]
+        if len(chunks) > len(indices):
+            try:
+                indices.extend(self.__free_reference_indices(identifier, record, len(chunks)-len(indices), 
+                                                             indices[-1] if indices else REFERENCE_INDEX_START-1))
+            except IllegalHandleStructureError:
+                # no room above the last chunk; place all chunks anew, the key's own indices counting as free
+                others = dict((idx, v) for idx, v in record.iteritems() if idx not in indices)
+                placed = self.__free_reference_indices(identifier, others, len(chunks))
+                indices = placed + sorted(set(indices) - set(placed))
+        values = {}
+        for index, chunk in zip(indices, chunks):
+            values[index] = (key, json.dumps(chunk))
+        obsolete = indices[len(chunks):]
+        self._write_pid_values(identifier, values)
+        self._remove_pid_values(identifier, obsolete)
+        record.update(values)
+        for index in obsolete:
+            del record[index]
+            
+    def _append_reference(self, identifier, key, reference, references, record=None):
+        # only the last chunk is rewritten, or a new one started if it is full
+        record = self.__read_reference_values(identifier, record)
+        indices = self.__reference_indices(record, key)
+        chunk = None
+        if indices:
+            index = indices[-1]
+            chunk = json.loads(record[index][1])
+        if chunk is None or len(chunk) >= REFERENCE_CHUNK_SIZE:
+            try:
+                index = self.__free_reference_indices(identifier, record, 1, indices[-1] if indices else REFERENCE_INDEX_START-1)[0]
+            except IllegalHandleStructureError:
+                # no room above the last chunk; rewrite the full list
+                self._write_reference(identifier, key, references, record)
+                return
+            chunk = []
+        chunk.append(reference)
+        value = json.dumps(chunk)
+        self._write_pid_value(identifier, index, key, value)
+        record[index] = (key, value)
             
             
     def create_alias(self, original, alias_identifier):
@@ -427,14 +546,15 @@ class HandleInfrastructure(DOInfrastructure):
         """
         return self._prefix + "/" + suffix
     
-    def manufacture_hashmap(self, identifier, characteristic_segment_number):
+    def manufacture_hashmap(self, identifier, characteristic_segment_number, record=None):
         """
         Factory method. Constructs Handle-based Hashmap implementation objects.
         
         :identifier: The PID of the record that should hold the hash map.
         :param: characteristic_segment_number: Since there can be multiple hash maps in a single record, this number
           is used to separate them from each other. 
+        :param: record: A snapshot of the record, if available.
         """
-        return HandleHashmapImpl(self, identifier, characteristic_segment_number)
+        return HandleHashmapImpl(self, identifier, characteristic_segment_number, record)
     
 
@@ -31,9 +31,19 @@ of the authors.
 '''
 from random import Random
 import string
-from lapis.model.do import DigitalObject
+import marshal
+from lapis.model.do import DigitalObject, SIZE_STRATEGY_COUNTER, SIZE_STRATEGY_DERIVED
 from lapis.model.hashmap import HandleHashmapImpl
 
+INDEX_ALIAS = 1
+VALUETYPE_ALIAS = "HS_ALIAS"
+INDEX_RESOURCE_TYPE = 2
+
+SNAPSHOT_MAGIC = "LAPISSNAP"
+SNAPSHOT_VERSION = 1
+SNAPSHOT_ELEMENT = 0
+SNAPSHOT_ALIAS = 1
+
 class DOInfrastructure(object):
     """
     A Digital Object Infrastructure (factory for Digital Object instances).
@@ -41,6 +51,9 @@ class DOInfrastructure(object):
     This is the main interface class for higher-level services that use Digital Objects. The infrastructure class must 
     be specialized to work on an underlying 'real-world' DO infrastructure (e.g. the Handle System).
     """
+    
+    # True if references are stored among the raw values returned by _read_all_pid_values
+    _references_in_values = False
 
 
     def __init__(self):
@@ -48,6 +61,18 @@ class DOInfrastructure(object):
         Constructor
         """
         self._random = Random()
+        self._record_cache = None
+        self._collection_size_strategy = SIZE_STRATEGY_COUNTER
+        
+    @classmethod
+    def from_config(cls, config):
+        """
+        Factory method. Constructs an instance from the given configuration. Used by :func:`lapis.infra.registry.connect`; 
+        infrastructures that need parameters must override this.
+        
+        :param config: A ConfigParser instance.
+        """
+        return cls()
         
     def set_random_seed(self, seed):
         """
@@ -57,6 +82,43 @@ class DOInfrastructure(object):
         """
         self._random.seed(seed)
         
+    def set_record_cache(self, cache):
+        """
+        Sets a cache for resolved PID records. Not every infrastructure will make use of a cache.
+        
+        The cache is consulted by :meth:`lookup_pid` and by read-only scans of record segments, e.g. iterating over set
+        members or resolving parents; all raw reads that modifications are based on go to the infrastructure. Records 
+        modified through this instance are invalidated after every write. Resolved objects and scan results may
+        still be outdated by up to the cache's TTL, since modifications by other clients are not noticed, and a record 
+        fetched by a concurrent lookup just before a write may be stored again after the invalidation.
+        
+        :param cache: A :class:`.RecordCache` instance or None to disable caching.
+        """
+        self._record_cache = cache
+        
+    def set_collection_size_strategy(self, strategy):
+        """
+        Sets how sets created from now on keep track of their size. With ``"counter"`` (the default), a counter value
+        is read and written on every modification, so that determining the size is cheap. With ``"derived"``, no 
+        counter is maintained and the size is determined by reading the set's hash map segment; this saves requests on
+        modifications and avoids lost counter updates by concurrent writers, which otherwise touch independent buckets.
+        Existing sets keep their strategy. Arrays and linked lists always use a counter: array writers need the size to 
+        determine the index to write to anyway, and linked list elements are not stored in the list's own record.
+        
+        :param strategy: ``"counter"`` or ``"derived"``.
+        """
+        if strategy not in (SIZE_STRATEGY_COUNTER, SIZE_STRATEGY_DERIVED):
+            raise ValueError("Unknown collection size strategy: %s" % strategy)
+        self._collection_size_strategy = strategy
+        
+    def _invalidate_cached_record(self, identifier):
+        """
+        Removes the record of the given identifier from the record cache, if there is one. Must be called by every
+        method that modifies a record.
+        """
+        if self._record_cache:
+            self._record_cache.invalidate(identifier)
+        
     def create_do(self, identifier=None, do_class=None):
         """
         Factory method. Creates a new DO and returns the instance.
@@ -86,8 +148,11 @@ class DOInfrastructure(object):
             id = self._acquire_pid(id)
         # we have an id, now we can create the DO object
         if do_class:
-            return do_class(self, id)            
-        return DigitalObject(self, id)
+            dobj = do_class(self, id)
+        else:
+            dobj = DigitalObject(self, id)
+        dobj._initialize_record()
+        return dobj
     
     def _generate_random_identifier(self):
         """
@@ -135,6 +200,17 @@ class DOInfrastructure(object):
         """
         raise NotImplementedError()
     
+    def _write_pid_values(self, identifier, values):
+        """
+        Writes several (index, type, value) entries to a PID record. Infrastructures should override this to write
+        all entries in a single operation; the default implementation writes them one by one.
+        
+        :param identifier: the full identifier.
+        :param values: a dict with indexes as keys and (type, value) tuples as values.
+        """
+        for index, (valuetype, value) in sorted(values.iteritems()):
+            self._write_pid_value(identifier, index, valuetype, value)
+    
     def _read_pid_value(self, identifier, index):
         """
         Reads a single (type, value) entry from a PID record at given index.
@@ -155,6 +231,17 @@ class DOInfrastructure(object):
         """
         raise NotImplementedError()
     
+    def _remove_pid_values(self, identifier, indices):
+        """
+        Removes several values from a PID record. Infrastructures should override this to remove all values in a 
+        single operation; the default implementation removes them one by one.
+        
+        :param identifier: the full identifier.
+        :param indices: a list of indexes.
+        """
+        for index in indices:
+            self._remove_pid_value(identifier, index)
+    
     def _read_all_pid_values(self, identifier):
         """
         Reads the full PID record.
@@ -163,6 +250,60 @@ class DOInfrastructure(object):
         :return: a dict with indexes as keys and (type, value) tuples as values.
         """
         raise NotImplementedError()
+    
+    def _read_cached_pid_values(self, identifier):
+        """
+        Reads the full PID record like :meth:`_read_all_pid_values`, but may serve it from the record cache. Must only 
+        be used by read-only operations, since the result may be outdated. Infrastructures that make use of a record 
+        cache should override this; the default implementation always reads the record.
+        
+        :param identifier: the full identifier.
+        :return: a dict with indexes as keys and (type, value) tuples as values.
+        """
+        return self._read_all_pid_values(identifier)
+    
+    def _read_pid_value_range(self, identifier, lo, hi, cached=False):
+        """
+        Reads all assigned values of a PID record within an interval of indexes. Infrastructures that can filter index 
+        ranges server-side should override this; the default implementation filters the full record.
+        
+        :param identifier: the full identifier.
+        :param lo: the lowest index of the interval.
+        :param hi: the first index after the interval.
+        :param cached: if True, the record may be served from the record cache, see :meth:`_read_cached_pid_values`. 
+          Reads that modifications are based on must not set this.
+        :return: a dict with indexes as keys and (type, value) tuples as values.
+        """
+        if cached:
+            record = self._read_cached_pid_values(identifier)
+        else:
+            record = self._read_all_pid_values(identifier)
+        return dict((index, v) for index, v in record.iteritems() if lo <= index < hi)
+    
+    def _write_reference(self, identifier, key, reference, record=None):
+        """
+        Stores the full list of references of given key, replacing all previously stored references of that key.
+        
+        :param identifier: the full identifier.
+        :param key: the reference key (semantics).
+        :param reference: a list of PID strings. If empty, all references of given key are removed.
+        :param record: the record snapshot of the Digital Object, if available. Infrastructures may use it instead of
+          reading the record and must then keep it up to date.
+        """
+        raise NotImplementedError()
+    
+    def _append_reference(self, identifier, key, reference, references, record=None):
+        """
+        Stores a single reference that has been appended to the references of given key. Infrastructures should 
+        override this to write only the new reference; the default implementation rewrites the full list.
+        
+        :param identifier: the full identifier.
+        :param key: the reference key (semantics).
+        :param reference: the appended PID string.
+        :param references: the full list of references of given key, including the appended one.
+        :param record: the record snapshot of the Digital Object, see :meth:`_write_reference`.
+        """
+        self._write_reference(identifier, key, references, record)
    
     def delete_do(self, identifier):
         """
@@ -265,14 +406,17 @@ class InMemoryInfrastructure(DOInfrastructure):
             """
             from lapis.model.doset import DigitalObjectSet
             from lapis.model.dolist import DigitalObjectArray, DigitalObjectLinkedList
+            record = dict(self._hashmap)
+            # instances must not share the stored reference lists, or edits would modify storage directly
+            references = dict((k, list(v)) for k, v in self._references.iteritems())
             if self._resource_type == DigitalObjectSet.RESOURCE_TYPE:
-                dobj = DigitalObjectSet(do_infra, identifier, references=self._references, alias_identifiers=aliases)
+                dobj = DigitalObjectSet(do_infra, identifier, references=references, alias_identifiers=aliases, record=record)
             elif self._resource_type == DigitalObjectArray.RESOURCE_TYPE:
-                dobj = DigitalObjectArray(do_infra, identifier, references=self._references, alias_identifiers=aliases)
+                dobj = DigitalObjectArray(do_infra, identifier, references=references, alias_identifiers=aliases, record=record)
             elif self._resource_type == DigitalObjectLinkedList.RESOURCE_TYPE:
-                dobj = DigitalObjectLinkedList(do_infra, identifier, references=self._references, alias_identifiers=aliases)
+                dobj = DigitalObjectLinkedList(do_infra, identifier, references=references, alias_identifiers=aliases, record=record)
             else:
-                dobj = DigitalObject(do_infra, identifier, self._references, aliases)
+                dobj = DigitalObject(do_infra, identifier, references, aliases, record=record)
             return dobj
         
     class InMemoryElementAlias(object):
@@ -316,7 +460,9 @@ class InMemoryInfrastructure(DOInfrastructure):
     def _acquire_pid(self, identifier):
         if identifier in self._storage:
             raise PIDAlreadyExistsError()
-        self._storage[identifier] = InMemoryInfrastructure.InMemoryElement() # empty object to reserve key
+        ele = InMemoryInfrastructure.InMemoryElement() # empty object to reserve key
+        ele._identifier = identifier
+        self._storage[identifier] = ele
         return identifier
         
     def lookup_pid(self, identifier):
@@ -336,6 +482,9 @@ class InMemoryInfrastructure(DOInfrastructure):
         if not ele:
             raise KeyError("Identifier not assigned: %s" % identifier)
         ele._hashmap[index] = (valuetype, value)
+        if index == INDEX_RESOURCE_TYPE:
+            # keep the element's class information in sync with raw writes
+            ele._resource_type = value
         
     def _remove_pid_value(self, identifier, index):
         ele = self._storage.get(identifier)
@@ -347,6 +496,9 @@ class InMemoryInfrastructure(DOInfrastructure):
         ele = self._storage.get(identifier)
         if not ele:
             raise KeyError("Identifier not assigned: %s" % identifier)
+        if isinstance(ele, InMemoryInfrastructure.InMemoryElementAlias):
+            # represent aliases the same way as the Handle System does
+            return {INDEX_ALIAS: (VALUETYPE_ALIAS, ele._original_id)}
         return dict(ele._hashmap)
     
     def _storage_resolve(self, identifier):
@@ -360,11 +512,14 @@ class InMemoryInfrastructure(DOInfrastructure):
             return self._storage_resolve(ele._original_id)
         return ele
     
-    def _write_reference(self, identifier, key, reference):
+    def _write_reference(self, identifier, key, reference, record=None):
         ele = self._storage_resolve(identifier)
         if not ele:
             raise KeyError
-        ele._references[key] = reference
+        if reference:
+            ele._references[key] = list(reference)
+        else:
+            ele._references.pop(key, None)
         
     def create_alias(self, original, alias_identifier):
         # check for existing PID
@@ -395,8 +550,59 @@ class InMemoryInfrastructure(DOInfrastructure):
             raise KeyError()
         return isinstance(ele, InMemoryInfrastructure.InMemoryElementAlias)
             
-    def manufacture_hashmap(self, identifier, characteristic_segment_number):
-        return HandleHashmapImpl(self, identifier, characteristic_segment_number)
+    def manufacture_hashmap(self, identifier, characteristic_segment_number, record=None):
+        return HandleHashmapImpl(self, identifier, characteristic_segment_number, record)
+    
+    def save_snapshot(self, path):
+        """
+        Writes the complete state of this infrastructure to a file, from which it can be restored with 
+        :meth:`load_snapshot`. The snapshot uses the compact binary :mod:`marshal` format, which is specific to the
+        Python version that wrote it.
+        
+        :param path: Path of the snapshot file. An existing file will be overwritten.
+        """
+        elements = []
+        for identifier, ele in self._storage.iteritems():
+            if isinstance(ele, InMemoryInfrastructure.InMemoryElementAlias):
+                elements.append((SNAPSHOT_ALIAS, identifier, ele._original_id))
+            else:
+                elements.append((SNAPSHOT_ELEMENT, identifier, ele._resource_location, ele._resource_type, ele._references, ele._hashmap))
+        f = open(path, "wb")
+        try:
+            f.write(SNAPSHOT_MAGIC)
+            marshal.dump((SNAPSHOT_VERSION, elements), f)
+        finally:
+            f.close()
+    
+    def load_snapshot(self, path):
+        """
+        Replaces the complete state of this infrastructure with the one stored in the given snapshot file.
+        
+        :param path: Path of a file written by :meth:`save_snapshot`.
+        :raises: :exc:`IOError` if the file is not a snapshot of a supported version.
+        """
+        f = open(path, "rb")
+        try:
+            if f.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+                raise IOError("Not an infrastructure snapshot: %s" % path)
+            version, elements = marshal.load(f)
+        finally:
+            f.close()
+        if version != SNAPSHOT_VERSION:
+            raise IOError("Unsupported snapshot version %s in %s" % (version, path))
+        storage = dict()
+        for e in elements:
+            if e[0] == SNAPSHOT_ALIAS:
+                storage[e[1]] = InMemoryInfrastructure.InMemoryElementAlias(e[2])
+            else:
+                ele = InMemoryInfrastructure.InMemoryElement()
+                ele._identifier = e[1]
+                ele._resource_location = e[2]
+                ele._resource_type = e[3]
+                ele._references = e[4]
+                ele._hashmap = e[5]
+                storage[e[1]] = ele
+        self._storage = storage
     
 class PIDAlreadyExistsError(Exception):
     """
@@ -0,0 +1,124 @@
+'''
+Registry of infrastructure backends and construction of infrastructure instances from configurations.
+'''
+from ConfigParser import RawConfigParser
+
+"""
+Name of the setuptools entry point group through which additional infrastructure backends can be registered.
+"""
+ENTRY_POINT_GROUP = "lapis.backends"
+
+"""
+Backend used if a configuration does not name one.
+"""
+DEFAULT_BACKEND = "handle"
+
+"""
+Registered backends, mapping names to infrastructure classes or to "module:class" strings that are only imported once
+the backend is used. The built-in backends are also declared as entry points in setup.py.
+"""
+_backends = {
+    "memory": "lapis.infra.infrastructure:InMemoryInfrastructure",
+    "handle": "lapis.infra.handleinfrastructure:HandleInfrastructure",
+}
+
+
+def register_backend(name, backend):
+    """
+    Registers an infrastructure backend under the given name, replacing any backend of the same name.
+    
+    :param name: The backend name as used in configurations.
+    :param backend: A :class:`.DOInfrastructure` subclass or a "module:class" string naming one.
+    """
+    _backends[name] = backend
+
+
+def get_backend(name):
+    """
+    Returns the infrastructure class of the backend with given name. Only the module of that backend is imported.
+    Backends not registered through :func:`register_backend` are searched for among the setuptools entry points.
+    
+    :raises: :exc:`KeyError` if no backend of that name exists.
+    """
+    backend = _backends.get(name)
+    if backend is None:
+        import pkg_resources
+        for ep in pkg_resources.iter_entry_points(ENTRY_POINT_GROUP, name):
+            backend = ep.load()
+            break
+        else:
+            raise KeyError("Unknown infrastructure backend: %s" % name)
+    elif isinstance(backend, basestring):
+        module_name, class_name = backend.split(":", 1)
+        module = __import__(module_name, fromlist=[class_name])
+        backend = getattr(module, class_name)
+    _backends[name] = backend
+    return backend
+
+
+def load_config(config):
+    """
+    Normalizes the given configuration to a ConfigParser instance. Values read from files or dicts are not 
+    interpolated, so they may contain ``%`` characters, e.g. in passwords.
+    
+    :param config: A ConfigParser instance, a path to a configuration file or a dict of dicts mapping section names to
+      options.
+    """
+    if isinstance(config, RawConfigParser):
+        return config
+    parser = RawConfigParser()
+    if isinstance(config, basestring):
+        if not parser.read(config):
+            raise IOError("Could not read configuration file: %s" % config)
+    else:
+        for section, options in config.iteritems():
+            parser.add_section(section)
+            for option, value in options.iteritems():
+                parser.set(section, option, "%s" % value)
+    return parser
+
+
+def connect(config):
+    """
+    Constructs an infrastructure instance as described by the given configuration.
+    
+    The backend is chosen through the option ``backend`` in section ``lapis`` (default: ``handle``); all other options
+    are interpreted by the backend class, except ``size_strategy`` in section ``lapis``, see 
+    :meth:`.DOInfrastructure.set_collection_size_strategy`. An optional section ``cache`` configures a record cache through the options
+    ``type`` (``disk`` or ``shm``), ``path``, ``ttl`` and, depending on the type, ``max_entries`` or ``slots`` and
+    ``slot_size``.
+    
+    :param config: A ConfigParser instance, a path to a configuration file or a dict of dicts.
+    :returns: a :class:`.DOInfrastructure` instance.
+    """
+    config = load_config(config)
+    name = DEFAULT_BACKEND
+    if config.has_option("lapis", "backend"):
+        name = config.get("lapis", "backend")
+    infra = get_backend(name).from_config(config)
+    if config.has_option("lapis", "size_strategy"):
+        infra.set_collection_size_strategy(config.get("lapis", "size_strategy"))
+    if config.has_section("cache"):
+        infra.set_record_cache(_cache_from_config(config))
+    return infra
+
+
+def _cache_from_config(config):
+    from lapis.infra import cache
+    cache_type = config.get("cache", "type")
+    path = config.get("cache", "path")
+    ttl = cache.DEFAULT_TTL
+    if config.has_option("cache", "ttl"):
+        ttl = config.getint("cache", "ttl")
+    if cache_type == "disk":
+        max_entries = cache.DEFAULT_MAX_ENTRIES
+        if config.has_option("cache", "max_entries"):
+            max_entries = config.getint("cache", "max_entries")
+        return cache.DiskRecordCache(path, ttl=ttl, max_entries=max_entries)
+    if cache_type == "shm":
+        kwargs = {}
+        for option in ("slots", "slot_size"):
+            if config.has_option("cache", option):
+                kwargs[option] = config.getint("cache", option)
+        return cache.SharedMemoryRecordCache(path, ttl=ttl, **kwargs)
+    raise ValueError("Unknown record cache type: %s" % cache_type)
@@ -0,0 +1,204 @@
+'''
+Incremental one-way copying of PID records from one infrastructure to another.
+'''
+import os
+import hashlib
+import logging
+from multiprocessing.pool import ThreadPool
+from lapis.infra.infrastructure import PIDAlreadyExistsError, PIDAliasBrokenError, VALUETYPE_ALIAS
+from lapis.model.do import DEFAULT_WORKERS
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+logger = logging.getLogger(__name__)
+
+VALUETYPE_ADMIN = "HS_ADMIN"
+
+RESULT_COPIED = "copied"
+RESULT_UNCHANGED = "unchanged"
+RESULT_FAILED = "failed"
+RESULT_DELETED = "deleted"
+RESULT_SKIPPED = "skipped"
+
+
+def record_digest(values, references=None):
+    """
+    Computes a content hash of a PID record.
+    
+    :param values: a dict with indexes as keys and (type, value) tuples as values.
+    :param references: a dict with reference keys as keys and lists of PIDs as values, if the references are not part
+      of the values.
+    :returns: a hex digest string that is independent of the order of values.
+    """
+    content = sorted(values.items())
+    if references is not None:
+        content = [content, sorted(references.items())]
+    return hashlib.sha1(json.dumps(content)).hexdigest()
+
+
+class InfrastructureMirror(object):
+    """
+    Copies PID records from one Digital Object infrastructure to another, e.g. to keep a local read replica of Handle
+    records.
+    
+    Records are copied value by value, so that collection index segments, parent slots and all other internal structures
+    are preserved exactly. Alias records are recreated as aliases on the target. Administrative values (HS_ADMIN) are
+    left to the target infrastructure. Each record is written with a single batched write and several records are
+    copied concurrently. If the source or the target keeps references outside of the raw values (as the in-memory 
+    infrastructure does), references are additionally copied through the target's reference methods.
+    
+    Records that no longer exist at the source are deleted from the target.
+    
+    The mirror remembers a content hash of every record it copied. Subsequent runs only write records whose content
+    has changed since; if a state file is given, this knowledge survives between runs.
+    """
+
+    def __init__(self, source, target, state_path=None, workers=DEFAULT_WORKERS):
+        """
+        Constructor.
+        
+        :param source: The :class:`.DOInfrastructure` to copy records from.
+        :param target: The :class:`.DOInfrastructure` to copy records to.
+        :param state_path: Optional path to a file storing the content hashes of copied records between runs.
+        :param workers: Number of records to copy concurrently.
+        """
+        self._source = source
+        self._target = target
+        self._state_path = state_path
+        self._workers = workers
+        self._digests = {}
+        if state_path and os.path.exists(state_path):
+            f = open(state_path, "r")
+            try:
+                self._digests = json.load(f)
+            finally:
+                f.close()
+
+    def sync(self, identifiers):
+        """
+        Copies the records of the given identifiers from source to target, skipping all records that did not change
+        since they were last copied.
+        
+        :param identifiers: An iterable of identifier strings.
+        :returns: a dict with the number of records copied, unchanged, deleted (from the target, since they no longer 
+          exist at the source), skipped (existing at neither side) and failed.
+        """
+        pool = ThreadPool(self._workers)
+        try:
+            results = pool.map(self._sync_record, list(identifiers))
+        finally:
+            pool.close()
+            pool.join()
+        self.save_state()
+        stats = {RESULT_COPIED: 0, RESULT_UNCHANGED: 0, RESULT_DELETED: 0, RESULT_SKIPPED: 0, RESULT_FAILED: 0}
+        for r in results:
+            stats[r] += 1
+        return stats
+
+    def save_state(self):
+        """
+        Writes the content hashes of all copied records to the state file, if one was given.
+        """
+        if not self._state_path:
+            return
+        f = open(self._state_path, "w")
+        try:
+            json.dump(self._digests, f)
+        finally:
+            f.close()
+
+    def _sync_record(self, identifier):
+        """
+        Copies a single record if it has changed.
+        
+        :returns: one of the RESULT_* constants.
+        """
+        try:
+            try:
+                values = self.__strip_admin_values(self._source._read_all_pid_values(identifier))
+            except Exception:
+                if self.__exists(self._source, identifier):
+                    raise
+                return self.__delete(identifier)
+            alias_target = None
+            for t, v in values.itervalues():
+                if t == VALUETYPE_ALIAS:
+                    alias_target = v
+            references = None
+            if not alias_target and not (self._source._references_in_values and self._target._references_in_values):
+                references = self.__read_references(self._source, identifier)
+            digest = record_digest(values, references)
+            if self._digests.get(identifier) == digest:
+                return RESULT_UNCHANGED
+            if alias_target:
+                self.__copy_alias(identifier, alias_target)
+            else:
+                self.__copy_values(identifier, values)
+                if references is not None:
+                    self.__copy_references(identifier, references)
+            self._digests[identifier] = digest
+            return RESULT_COPIED
+        except Exception as exc:
+            logger.warning("Could not mirror record %s: %s" % (identifier, exc))
+            return RESULT_FAILED
+        
+    @staticmethod
+    def __exists(infra, identifier):
+        try:
+            return infra.lookup_pid(identifier) is not None
+        except PIDAliasBrokenError:
+            return True
+        
+    def __delete(self, identifier):
+        self._digests.pop(identifier, None)
+        try:
+            if not self._target.delete_alias(identifier):
+                self._target.delete_do(identifier)
+        except KeyError:
+            return RESULT_SKIPPED
+        return RESULT_DELETED
+    
+    @staticmethod
+    def __read_references(infra, identifier):
+        dobj = infra.lookup_pid(identifier)
+        if dobj is None:
+            raise KeyError("Identifier not assigned: %s" % identifier)
+        references = {}
+        for k in dobj.iter_reference_keys():
+            refs = dobj.get_reference_pids(k)
+            if refs:
+                references[k] = list(refs)
+        return references
+    
+    def __copy_references(self, identifier, references):
+        existing = self.__read_references(self._target, identifier)
+        for key in set(existing) | set(references):
+            if existing.get(key) != references.get(key):
+                self._target._write_reference(identifier, key, references.get(key, []))
+
+    def __copy_alias(self, identifier, alias_target):
+        try:
+            self._target.create_alias(alias_target, identifier)
+        except PIDAlreadyExistsError:
+            # alias target may have changed; recreate
+            if not self._target.delete_alias(identifier):
+                raise ValueError("Target record %s is not an alias" % identifier)
+            self._target.create_alias(alias_target, identifier)
+
+    def __copy_values(self, identifier, values):
+        try:
+            self._target._acquire_pid(identifier)
+            existing = {}
+        except PIDAlreadyExistsError:
+            existing = self.__strip_admin_values(self._target._read_all_pid_values(identifier))
+        changed = dict((i, v) for i, v in values.iteritems() if existing.get(i) != v)
+        removed = [i for i in existing if i not in values]
+        self._target._write_pid_values(identifier, changed)
+        self._target._remove_pid_values(identifier, removed)
+
+    @staticmethod
+    def __strip_admin_values(values):
+        return dict((i, v) for i, v in values.iteritems() if v[0] != VALUETYPE_ADMIN)
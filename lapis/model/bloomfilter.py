@@ -0,0 +1,127 @@
+'''
+A serializable Bloom filter, used to summarize the members of Digital Object sets.
+'''
+import math
+import struct
+import base64
+import hashlib
+
+"""
+Default number of elements a new Bloom filter is sized for and its intended false positive rate at that size.
+"""
+DEFAULT_CAPACITY = 1024
+DEFAULT_ERROR_RATE = 0.01
+
+"""
+Fraction of removals (relative to the number of added elements) after which a filter should be rebuilt. Removed
+elements cannot be cleared from a Bloom filter, so they keep increasing the false positive rate.
+"""
+REBUILD_REMOVED_FRACTION = 0.25
+
+
+class BloomFilter(object):
+    """
+    A Bloom filter over identifier strings: a compact, probabilistic summary of a set of keys that never rejects a
+    contained key, but may accept a key that was not added (false positive).
+
+    The filter also counts the number of added elements and the number of elements removed from the summarized set
+    since it was built, so that its owner can decide when to rebuild it (see :meth:`needs_rebuild`). Filters are
+    serialized to a single string through :meth:`to_string`, which allows storing them as a PID record value.
+    """
+
+    def __init__(self, num_bits, num_hashes, capacity, bits=None, count=0, removed=0):
+        """
+        Constructor. Use :meth:`for_capacity` to create a filter of suitable size.
+
+        :param num_bits: Number of bits of the filter; must be a multiple of 8.
+        :param num_hashes: Number of bits set per key.
+        :param capacity: Number of elements the filter is sized for.
+        :param bits: The filter bits as a bytearray, or None for an empty filter.
+        """
+        if num_bits <= 0 or num_bits % 8:
+            raise ValueError("Invalid number of Bloom filter bits: %s" % num_bits)
+        self.num_bits = num_bits
+        self.num_hashes = num_hashes
+        self.capacity = capacity
+        if bits is None:
+            bits = bytearray(num_bits // 8)
+        elif len(bits) * 8 != num_bits:
+            raise ValueError("Bloom filter bits do not match the filter size!")
+        self.bits = bits
+        self.count = count
+        self.removed = removed
+
+    @classmethod
+    def for_capacity(cls, capacity=DEFAULT_CAPACITY, error_rate=DEFAULT_ERROR_RATE):
+        """
+        Creates an empty filter that has the given false positive rate once it holds the given number of elements.
+        """
+        capacity = max(capacity, 1)
+        num_bits = int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        num_bits = max(8, (num_bits + 7) // 8 * 8)
+        num_hashes = max(1, int(round(float(num_bits) / capacity * math.log(2))))
+        return cls(num_bits, num_hashes, capacity)
+
+    def error_rate(self):
+        """
+        Returns the expected false positive rate of the filter once it holds as many elements as it is sized for.
+        """
+        return (1.0 - math.exp(-float(self.num_hashes) * self.capacity / self.num_bits)) ** self.num_hashes
+
+    def __positions(self, key):
+        if isinstance(key, unicode):
+            key = key.encode("utf-8")
+        # double hashing: k positions from two independent 64 bit hashes
+        h1, h2 = struct.unpack("<QQ", hashlib.md5(key).digest())
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def add(self, key):
+        for pos in self.__positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def might_contain(self, key):
+        """
+        :returns: False if the key was definitely not added, True if it may have been added.
+        """
+        for pos in self.__positions(key):
+            if not self.bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def __contains__(self, key):
+        return self.might_contain(key)
+
+    def note_removed(self, n=1):
+        """
+        Records that n elements were removed from the summarized set. Their bits remain set.
+        """
+        self.removed += n
+
+    def needs_rebuild(self):
+        """
+        Returns True if the filter has exceeded its capacity or too many elements were removed since it was built, so
+        that the false positive rate has noticeably increased.
+        """
+        return self.count > self.capacity or self.removed > self.count * REBUILD_REMOVED_FRACTION
+
+    def to_string(self):
+        """
+        Serializes the filter, see :meth:`from_string`.
+        """
+        return "%s:%s:%s:%s:%s" % (self.num_hashes, self.capacity, self.count, self.removed,
+                                   base64.b64encode(str(self.bits)))
+
+    @classmethod
+    def from_string(cls, s):
+        """
+        Reconstructs a filter serialized by :meth:`to_string`.
+
+        :raises: :exc:`ValueError` if the string is not a serialized filter.
+        """
+        try:
+            num_hashes, capacity, count, removed, data = s.split(":", 4)
+            bits = bytearray(base64.b64decode(data))
+            return cls(len(bits) * 8, int(num_hashes), int(capacity), bits, int(count), int(removed))
+        except (TypeError, ValueError):
+            raise ValueError("Not a serialized Bloom filter: %r" % s[:64])
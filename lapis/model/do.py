@@ -45,6 +45,47 @@ SEGMENT_PARENTS_MASK_VALUE = 1 << PAYLOAD_BITS
 SEGMENT_PARENTS_TARGET_MASK_BITS = 17
 MAX_PARENTS = 2 ** SEGMENT_PARENTS_TARGET_MASK_BITS - 1
 VALUETYPE_PARENT_OBJECT = "PARENT_OBJECT"
+BASE_INDEX_PARENT_COUNT = 3000
+VALUETYPE_PARENT_COUNT = "PARENT_COUNT"
+
+INDEX_RESOURCE_LOCATION = 1
+INDEX_RESOURCE_TYPE = 2
+VALUETYPE_RESOURCE_LOCATION = "URL"
+VALUETYPE_RESOURCE_TYPE = "RESOURCE_TYPE"
+
+"""
+Size strategies for sets. With the counter strategy, the size is stored in a counter value that is updated on 
+every modification. With the derived strategy, the size value only carries the type VALUETYPE_DERIVED_SIZE as a 
+marker, and the size is determined by counting the values of the set's hash map segment.
+"""
+SIZE_STRATEGY_COUNTER = "counter"
+SIZE_STRATEGY_DERIVED = "derived"
+VALUETYPE_DERIVED_SIZE = "DERIVED_SIZE"
+
+"""
+Default number of records updated or resolved concurrently by bulk operations, e.g. :meth:`.DigitalObjectSet.add_do`,
+prefetching iteration and :class:`.InfrastructureMirror`. The Handle infrastructure keeps as many connections open by
+default, see :data:`lapis.infra.handleinfrastructure.DEFAULT_CONNECTIONS`.
+"""
+DEFAULT_WORKERS = 8
+
+def intern_pid(s):
+    """
+    Returns the canonical instance of the given identifier string or reference key, so that equal strings held by
+    many Digital Objects (e.g. the PID of a common parent or reference target) share their memory. The built-in 
+    :func:`intern` is used, so canonical instances are freed once no longer referenced. Unicode strings are converted
+    to byte strings if they are plain ASCII, as identifiers usually are; others are returned unchanged.
+    
+    :param s: A string or None.
+    """
+    if s is None:
+        return None
+    if isinstance(s, unicode):
+        try:
+            s = s.encode("ascii")
+        except UnicodeEncodeError:
+            return s
+    return intern(s)
 
 
 class DigitalObject(object):
@@ -66,9 +107,14 @@ class DigitalObject(object):
     outside of this particular Python implementation (e.g. in a data archive). Thus, one might well state that class
     instances do not fully represent Digital Objects - the discussion about terminology and concepts is certainly still
     very much open.
+    
+    Instances use slots and create their reference and alias containers only when needed, so that large numbers of
+    them can be held in memory.
     """
+    
+    __slots__ = ("_id", "_do_infra", "_references", "_alias_identifiers", "_record", "_edit_record", "_dirty_reference_keys")
 
-    def __init__(self, do_infrastructure, identifier, references=None, alias_identifiers=None):
+    def __init__(self, do_infrastructure, identifier, references=None, alias_identifiers=None, record=None):
         """
         Constructor. Only called by the factory or other infrastructure methods that construct/reconstruct KeyMD 
         instances.
@@ -86,22 +132,171 @@ class DigitalObject(object):
         :param alias_identifiers: The alias PIDs that lead to this Digital Object. Only available if the DO was resolved through 
           an alias PID. This should be a list of identifier strings. The process which lead to the DO started at the 
           first list entry. The list will be assigned directly, not copied.
+        :param record: A snapshot of the full PID record as fetched by the infrastructure, i.e. a dict with indexes as 
+          keys and (type, value) tuples as values. If given, property reads are served from the snapshot instead of
+          the infrastructure until :meth:`refresh` is called. The dict will be assigned directly, not copied.
         """
-        self._id = identifier
+        self._id = intern_pid(identifier)
         self._do_infra = do_infrastructure
-        if references:
-            self._references = references
-        else:
-            self._references = {}
-        if alias_identifiers:
-            self._alias_identifiers = alias_identifiers
-        else:
-            self._alias_identifiers = []
+        self._references = references or None
+        self._alias_identifiers = alias_identifiers or None
+        self._record = record
+        self._edit_record = None
+        self._dirty_reference_keys = None
     
     def _get_do_infrastructure(self):
         return self._do_infra        
     
+    def _initialize_record(self):
+        """
+        Writes the initial structural values of a newly created Digital Object (e.g. the size of a collection). Called
+        exactly once by the infrastructure's factory method; constructors must not access the infrastructure, since 
+        they are also used to reconstruct existing objects.
+        """
+        pass
+    
     infrastructure = property(_get_do_infrastructure, doc="The infrastructure this instance is using.")
+    
+    def _read_value(self, index):
+        """
+        Reads a single (type, value) entry of this DO's record. In edit mode, the edited record is used; otherwise the
+        record snapshot if there is one.
+        
+        :returns: a (type, value) tuple or None if the index is unassigned.
+        """
+        if self._edit_record is not None:
+            return self._edit_record.get(index)
+        if self._record is not None:
+            return self._record.get(index)
+        return self._do_infra._read_pid_value(self._id, index)
+    
+    def _read_values(self):
+        """
+        Reads all entries of this DO's record at once. In edit mode, the edited record is used; otherwise the record 
+        snapshot if there is one.
+        
+        :returns: a dict with indexes as keys and (type, value) tuples as values. The dict must not be modified.
+        """
+        if self._edit_record is not None:
+            return self._edit_record
+        if self._record is not None:
+            return self._record
+        return self._do_infra._read_all_pid_values(self._id)
+    
+    def _write_value(self, index, valuetype, value):
+        """
+        Writes a single (index, type, value) entry to this DO's record and keeps the record snapshot up to date. In
+        edit mode, only the edited record is changed.
+        """
+        if self._edit_record is not None:
+            self._edit_record[index] = (valuetype, value)
+            return
+        self._do_infra._write_pid_value(self._id, index, valuetype, value)
+        if self._record is not None:
+            self._record[index] = (valuetype, value)
+            
+    def _remove_value(self, index):
+        """
+        Removes a single entry from this DO's record and keeps the record snapshot up to date. In edit mode, only the 
+        edited record is changed.
+        """
+        if self._edit_record is not None:
+            self._edit_record.pop(index, None)
+            return
+        self._do_infra._remove_pid_value(self._id, index)
+        if self._record is not None:
+            self._record.pop(index, None)
+            
+    def _store_references(self, ref_key, appended=None):
+        """
+        Writes the current references of given key to the infrastructure or, in edit mode, marks them for saving.
+        
+        :param appended: If given, the only change is that this reference was appended. 
+        """
+        if self._dirty_reference_keys is not None:
+            self._dirty_reference_keys.add(ref_key)
+            return
+        if appended is not None:
+            self._do_infra._append_reference(self._id, ref_key, appended, self.get_reference_pids(ref_key), record=self._record)
+        else:
+            self._do_infra._write_reference(self._id, ref_key, self.get_reference_pids(ref_key), record=self._record)
+    
+    def refresh(self):
+        """
+        Re-reads the record of this Digital Object from the infrastructure, discarding the current record snapshot and
+        references. Leaves edit mode without saving.
+        
+        :raises: :exc:`KeyError` if the Digital Object no longer exists.
+        """
+        self._do_infra._invalidate_cached_record(self._id)
+        dobj = self._do_infra.lookup_pid(self._id)
+        if not dobj:
+            raise KeyError("Identifier no longer assigned: %s" % self._id)
+        self._record = dobj._record
+        self._references = dobj._references
+        self._edit_record = None
+        self._dirty_reference_keys = None
+        
+    def begin_edit(self):
+        """
+        Enters edit mode. In edit mode, changes made through the resource location and type setters, property methods
+        and reference methods only modify this instance. They are written to the infrastructure by :meth:`save`.
+        Operations of collection classes are not affected by edit mode.
+        
+        Edits are applied to the record snapshot, which is fetched first if this instance does not have one yet.
+        """
+        if self._record is None:
+            self.refresh()
+        self._edit_record = dict(self._record)
+        self._dirty_reference_keys = set()
+        
+    def _is_editing(self):
+        return self._edit_record is not None
+    
+    editing = property(_is_editing, doc="True if this instance is in edit mode (read-only).")
+        
+    def save(self):
+        """
+        Writes all changes made in edit mode to the infrastructure and leaves edit mode. Only the indices whose content
+        differs from the record snapshot are written or removed, each group in a single batch.
+        
+        :raises: :exc:`ValueError` if this instance is not in edit mode.
+        """
+        if self._edit_record is None:
+            raise ValueError("Digital Object %s is not in edit mode!" % self._id)
+        changed = dict((index, v) for index, v in self._edit_record.iteritems() if self._record.get(index) != v)
+        removed = [index for index in self._record if index not in self._edit_record]
+        self._do_infra._write_pid_values(self._id, changed)
+        self._do_infra._remove_pid_values(self._id, removed)
+        for ref_key in self._dirty_reference_keys:
+            self._do_infra._write_reference(self._id, ref_key, self.get_reference_pids(ref_key), record=self._edit_record)
+        self._record = self._edit_record
+        self._edit_record = None
+        self._dirty_reference_keys = None
+        
+    def discard_changes(self):
+        """
+        Leaves edit mode without writing any changes. The record snapshot and references are re-read from the 
+        infrastructure.
+        """
+        self.refresh()
+        
+    def release_snapshot(self):
+        """
+        Discards the record snapshot to save memory. Subsequent property reads will access the infrastructure. Has no
+        effect in edit mode.
+        """
+        if self._edit_record is None:
+            self._record = None
+            
+    def to_handle(self):
+        """
+        Returns a serializable handle for this Digital Object, e.g. for passing it to worker processes. Changes not yet
+        saved in edit mode are not included.
+        
+        :returns: A :class:`DigitalObjectHandle` instance.
+        """
+        return DigitalObjectHandle(self)
         
     def _set_resource_location(self, location):
         """
@@ -110,10 +305,10 @@ class DigitalObject(object):
         :param location: A string which provides domain-relevant information about the location of the referenced
             resource.
         """
-        self._do_infra._write_pid_value(self._id, 1, "URL", location)
+        self._write_value(INDEX_RESOURCE_LOCATION, VALUETYPE_RESOURCE_LOCATION, location)
         
     def _get_resource_location(self):
-        v = self._do_infra._read_pid_value(self._id, 1)
+        v = self._read_value(INDEX_RESOURCE_LOCATION)
         if not v:
             return None
         return v[1]
@@ -121,13 +316,13 @@ class DigitalObject(object):
     resource_location = property(_get_resource_location, _set_resource_location, doc="The location of the resource this DO refers to.")
         
     def _get_resource_type(self):
-        v = self._do_infra._read_pid_value(self._id, 2)
+        v = self._read_value(INDEX_RESOURCE_TYPE)
         if not v:
             return None
         return v[1]
     
     def _set_resource_type(self, resource_type):
-        self._do_infra._write_pid_value(self._id, 2, "RESOURCE_TYPE", resource_type)
+        self._write_value(INDEX_RESOURCE_TYPE, VALUETYPE_RESOURCE_TYPE, resource_type)
 
     _resource_type = property(_get_resource_type, _set_resource_type, doc="The type of this Digital Object's external data. The type of this Digital Object may also be implicit through its class; then, the resource type should be None.")
 
@@ -174,13 +369,17 @@ class DigitalObject(object):
             ref_key = semantics.identfier
         else:
             ref_key = semantics
+        ref = intern_pid(ref)
+        ref_key = intern_pid(ref_key)
         # now store in list, create a new list if necessary
+        if self._references is None:
+            self._references = {}
         if not ref_key in self._references:
             self._references[ref_key] = [ref]
         else:
             self._references[ref_key].append(ref)
         # write to do-infra
-        self._do_infra._write_reference(self._id, ref_key, self._references[ref_key])
+        self._store_references(ref_key, ref)
         
     def remove_do_reference(self, semantics, reference):
         """
@@ -207,9 +406,9 @@ class DigitalObject(object):
         else:
             ref_key = semantics
         # now remove from list
-        if ref_key in self._references:
+        if self._references and ref_key in self._references:
             self._references[ref_key].remove(ref)
-            self._do_infra._write_reference(self._id, ref_key, self._references[ref_key])
+            self._store_references(ref_key)
             return True
         else:
             return False
@@ -230,9 +429,9 @@ class DigitalObject(object):
         else:
             ref_key = semantics
         # now remove whole list
-        if ref_key in self._references:
+        if self._references and ref_key in self._references:
             del self._references[ref_key]
-            self._do_infra._write_references(self._id, ref_key, None)
+            self._store_references(ref_key)
             return True
         else:
             return False
@@ -269,7 +468,7 @@ class DigitalObject(object):
         else:
             ref_key = semantics
         # early exit if no such reference exists
-        if not ref_key in self._references:
+        if not self._references or not ref_key in self._references:
             return []
         # otherwise, assemble list of pids
         refs = self._references[ref_key]
@@ -280,6 +479,8 @@ class DigitalObject(object):
         """
         Returns an iterator over all reference keys.
         """
+        if not self._references:
+            return iter(())
         return self._references.iterkeys()
          
 
@@ -313,7 +514,7 @@ class DigitalObject(object):
         
         :returns: A list (may be empty).
         """
-        return list(self._alias_identifiers)
+        return list(self._alias_identifiers or ())
 
     def set_property_value(self, property_index, property_name, property_value):
         """
@@ -327,11 +528,45 @@ class DigitalObject(object):
         :param property_value: Value of the property. This can be any type, which will however be converted to a String. 
           The value may also be empty or None, in which case the property has a flag-type behaviour.
         """
-        current = self.infrastructure._read_pid_value(self.identifier, property_index)
+        current = self._read_value(property_index)
         if current and current[0] != property_name:
             raise PropertyNameMismatchError("Tried to assign value %s to a property with new type %s to existing type %s at index %s of identifier %s" 
                                             % (property_value, property_name, current[0], property_index, self.identifier))            
-        self.infrastructure._write_pid_value(self.identifier, property_index, "%s" % property_name, "%s" % property_value)
+        self._write_value(property_index, "%s" % property_name, "%s" % property_value)
+    
+    def set_properties(self, properties):
+        """
+        Sets several property values at once. Behaves like :meth:`set_property_value` for each of the given properties,
+        but needs only a single read and a single write on the infrastructure. If any of the properties has a name
+        mismatch, no value is written.
+        
+        :param properties: A dict with property indices as keys and (name, value) tuples as values.
+        :raises: :exc:`PropertyNameMismatchError` if an index is already in use by a property of different name.
+        """
+        current = self._read_values()
+        values = {}
+        for property_index, (property_name, property_value) in properties.iteritems():
+            v = current.get(property_index)
+            if v and v[0] != property_name:
+                raise PropertyNameMismatchError("Tried to assign value %s to a property with new type %s to existing type %s at index %s of identifier %s" 
+                                                % (property_value, property_name, v[0], property_index, self.identifier))
+            values[property_index] = ("%s" % property_name, "%s" % property_value)
+        if self._edit_record is not None:
+            self._edit_record.update(values)
+            return
+        self._do_infra._write_pid_values(self._id, values)
+        if self._record is not None:
+            self._record.update(values)
+    
+    def get_properties(self, property_indices):
+        """
+        Reads several property values at once, using a single read on the infrastructure.
+        
+        :param property_indices: An iterable of property indices.
+        :returns: A dict with the indices as keys and (name, value) tuples as values. Unassigned indices are omitted.
+        """
+        current = self._read_values()
+        return dict((i, current[i]) for i in property_indices if i in current)
     
     def get_property_value(self, property_index):
         """
@@ -342,11 +577,22 @@ class DigitalObject(object):
           empty/None, indicating a flag-type property.
         :raises: :exc:`KeyError` if the property has not been set.
         """
-        r = self.infrastructure._read_pid_value(self.identifier, property_index)
+        r = self._read_value(property_index)
         if not r:
             raise KeyError("Could not get property value: Index %s unassigned on identifier %s!" % (property_index, self.identifier))
         return r
     
+    def remove_property_value(self, property_index):
+        """
+        Removes a property value (key-metadata).
+        
+        :param property_index: Index of the property.
+        :raises: :exc:`KeyError` if the property has not been set.
+        """
+        if not self._read_value(property_index):
+            raise KeyError("Could not remove property value: Index %s unassigned on identifier %s!" % (property_index, self.identifier))
+        self._remove_value(property_index)
+    
     def is_property_assigned(self, property_index):
         """
         Checks whether the property at given index has been assigned.
@@ -354,58 +600,123 @@ class DigitalObject(object):
         :param property_index: Index of the property.
         :returns: True or False.
         """
-        r = self.infrastructure._read_pid_value(self.identifier, property_index)
+        r = self._read_value(property_index)
         return r != None
         
+    @staticmethod
+    def _parent_segment_target_mask(parent_dobj):
+        return (parent_dobj.CHARACTERISTIC_SEGMENT_NUMBER << SEGMENT_PARENTS_TARGET_MASK_BITS) + SEGMENT_PARENTS_MASK_VALUE
+    
+    def _count_parent_slots(self, parent_dobj):
+        """
+        Returns the number of occupied parent slots for the collection type of the given parent object. The number is
+        read from the parent counter; records written before the counter was introduced are migrated through 
+        :meth:`_compact_parent_slots` first.
+        """
+        v = self._do_infra._read_pid_value(self.identifier, BASE_INDEX_PARENT_COUNT+parent_dobj.CHARACTERISTIC_SEGMENT_NUMBER)
+        if v:
+            return int(v[1])
+        return self._compact_parent_slots(parent_dobj)
+    
+    def _compact_parent_slots(self, parent_dobj):
+        """
+        Migrates the parent slots of a record written before the parent counter was introduced. Earlier versions could
+        leave gaps between the occupied slots, so the slots are moved down to be gap-free, and the counter is written
+        along with them. The parent object is notified about every moved slot through :meth:`_member_slot_moved`. If
+        no slot needs to be moved, nothing is written; the caller writes the counter along with its own change.
+        
+        :returns: the number of occupied slots.
+        """
+        parent_segment_target_mask = self._parent_segment_target_mask(parent_dobj)
+        values = self._do_infra._read_pid_value_range(self.identifier, parent_segment_target_mask, parent_segment_target_mask + MAX_PARENTS)
+        moves = []
+        writes = {BASE_INDEX_PARENT_COUNT+parent_dobj.CHARACTERISTIC_SEGMENT_NUMBER: (VALUETYPE_PARENT_COUNT, len(values))}
+        for to_slot, index in enumerate(sorted(values)):
+            from_slot = index - parent_segment_target_mask
+            if from_slot != to_slot:
+                moves.append((values[index][1], from_slot, to_slot))
+                writes[parent_segment_target_mask + to_slot] = values[index]
+        if not moves:
+            return len(values)
+        self._do_infra._write_pid_values(self.identifier, writes)
+        self._do_infra._remove_pid_values(self.identifier, sorted(index for index in values if index - parent_segment_target_mask >= len(values)))
+        # in ascending order, every slot is moved into one that is already free
+        for owner_id, from_slot, to_slot in moves:
+            parent_dobj._member_slot_moved(self, owner_id, from_slot, to_slot)
+        return len(values)
+    
+    def _read_parent_slots(self, characteristic_segment_number, cached=False):
+        """
+        Reads all parent slots for the given collection type at once.
+        
+        :param cached: if True, the record may be served from the record cache; only for read-only use.
+        :returns: a list of parent identifiers, ordered by slot number.
+        """
+        offset = (characteristic_segment_number << SEGMENT_PARENTS_TARGET_MASK_BITS) + SEGMENT_PARENTS_MASK_VALUE
+        values = self._do_infra._read_pid_value_range(self.identifier, offset, offset + MAX_PARENTS, cached=cached)
+        return [values[index][1] for index in sorted(values)]
+    
     def _write_parent_info(self, parent_dobj):
         """
-        Writes a reference to a parent object.
+        Writes a reference to a parent object. The parent slots of each collection type are kept gap-free and their 
+        number is stored in a counter, so the next free slot is known without scanning.
         
         :param: parent_dobj: The parent digital object.
         :returns: the slot number (starting at 0, specific to the type of collection of parent_dobj)
         """
-        freeslot = 0
-        parent_segment_target_mask = (parent_dobj.CHARACTERISTIC_SEGMENT_NUMBER << SEGMENT_PARENTS_TARGET_MASK_BITS) + SEGMENT_PARENTS_MASK_VALUE 
-        while True:
-            v = self._do_infra._read_pid_value(self.identifier, parent_segment_target_mask + freeslot)
-            if v:
-                freeslot += 1
-                if v == MAX_PARENTS:
-                    raise Exception("No more free parent slots in %s (starting at Index %s)!" % (self.identifier, parent_segment_target_mask))
-                continue
-            break
-        # now write to freeslot
-        self._do_infra._write_pid_value(self.identifier, parent_segment_target_mask + freeslot, VALUETYPE_PARENT_OBJECT, parent_dobj.identifier)
+        parent_segment_target_mask = self._parent_segment_target_mask(parent_dobj)
+        freeslot = self._count_parent_slots(parent_dobj)
+        if freeslot >= MAX_PARENTS:
+            raise Exception("No more free parent slots in %s (starting at Index %s)!" % (self.identifier, parent_segment_target_mask))
+        # write to freeslot and update counter
+        self._do_infra._write_pid_values(self.identifier, {parent_segment_target_mask + freeslot: (VALUETYPE_PARENT_OBJECT, parent_dobj.identifier),
+                                                           BASE_INDEX_PARENT_COUNT+parent_dobj.CHARACTERISTIC_SEGMENT_NUMBER: (VALUETYPE_PARENT_COUNT, freeslot+1)})
         return freeslot
     
-    def _remove_parent_info(self, parent_dobj):
+    def _remove_parent_info(self, parent_dobj, dobj_slot=None):
         """
-        Removes a reference to the given parent object.
+        Removes a reference to the given parent object. To keep the parent slots gap-free, the highest occupied slot is
+        moved into the freed one, so a removal costs a constant number of writes. The parent object is notified about
+        the move through :meth:`_member_slot_moved`.
         
         :param: parent_dobj: The parent digital object.
+        :param: dobj_slot: The slot to free. If None, the first slot referring to parent_dobj is used.
         :returns: the slot number (starting at 0, specific to the type of collection of parent_dobj)
         """
-        dobj_slot = 0
-        parent_segment_target_mask = (parent_dobj.CHARACTERISTIC_SEGMENT_NUMBER << SEGMENT_PARENTS_TARGET_MASK_BITS) + SEGMENT_PARENTS_MASK_VALUE
-        while True:
-            v = self._do_infra._read_pid_value(self.identifier, parent_segment_target_mask + dobj_slot)
-            if not v or dobj_slot == MAX_PARENTS:
+        parent_segment_target_mask = self._parent_segment_target_mask(parent_dobj)
+        n = self._count_parent_slots(parent_dobj)
+        if dobj_slot is None:
+            try:
+                dobj_slot = self._read_parent_slots(parent_dobj.CHARACTERISTIC_SEGMENT_NUMBER).index(parent_dobj.identifier)
+            except ValueError:
                 raise ValueError("Object %s is not part of given parent collection %s!" % (self.identifier, parent_dobj.identifier))
-            if v[1] == parent_dobj.identifier:
-                break
-            dobj_slot += 1
-        # now remove info from slot
-        self._do_infra._remove_pid_value(self.identifier, parent_segment_target_mask + dobj_slot)
-        result = dobj_slot
-        # must also shift all higher entries so that there are no gaps - if there were gaps, the 'if not v' in the loop
-        # above will not work as expected
-        while dobj_slot < MAX_PARENTS:
-            dobj_slot += 1
-            v = self._do_infra._read_pid_value(self.identifier, parent_segment_target_mask + dobj_slot)
-            if not v: 
-                break
-            self._do_infra._write_pid_value(self.identifier, parent_segment_target_mask + dobj_slot - 1, v[0], v[1])
-        return result
+        last_slot = n-1
+        # the moved slot and the counter are written together, so the counter never disagrees with the slots; the
+        # last slot is removed afterwards, when it is no longer counted
+        values = {BASE_INDEX_PARENT_COUNT+parent_dobj.CHARACTERISTIC_SEGMENT_NUMBER: (VALUETYPE_PARENT_COUNT, last_slot)}
+        moved = None
+        if dobj_slot != last_slot:
+            # move last slot into the freed one
+            moved = self._do_infra._read_pid_value(self.identifier, parent_segment_target_mask + last_slot)
+            values[parent_segment_target_mask + dobj_slot] = moved
+        self._do_infra._write_pid_values(self.identifier, values)
+        self._do_infra._remove_pid_value(self.identifier, parent_segment_target_mask + last_slot)
+        if moved:
+            parent_dobj._member_slot_moved(self, moved[1], last_slot, dobj_slot)
+        return dobj_slot
+    
+    def _member_slot_moved(self, member_dobj, owner_id, from_slot, to_slot):
+        """
+        Called on a collection when a parent slot of one of its members was moved by :meth:`_remove_parent_info`.
+        Collections that store slot-specific information on their members must move it along. Note that the moved slot
+        may belong to a different collection of the same type than this one.
+        
+        :param member_dobj: The member whose parent slot was moved.
+        :param owner_id: Identifier of the collection the moved slot refers to.
+        :param from_slot: The former slot number.
+        :param to_slot: The new slot number.
+        """
+        pass
     
     def get_parent_pids(self, characteristic_segment_number):
         """
@@ -413,18 +724,45 @@ class DigitalObject(object):
         
         :param: characteristic_segment_number: designates the type of collection to filter.
         """
-        offset = (characteristic_segment_number << SEGMENT_PARENTS_TARGET_MASK_BITS) + SEGMENT_PARENTS_MASK_VALUE
-        i = 0
-        parents = set()
-        while i < MAX_PARENTS:
-            v = self._do_infra._read_pid_value(self.identifier, offset + i)
-            if not v:
-                break
-            parents.add(v[1])
-            i += 1 
-        return parents
+        return set(intern_pid(p) for p in self._read_parent_slots(characteristic_segment_number, cached=True))
                     
 
+class DigitalObjectHandle(object):
+    """
+    Lightweight, picklable stand-in for a Digital Object. 
+    
+    Digital Object instances cannot be pickled since they hold their infrastructure, which in turn holds connection
+    pools and credentials. A handle only stores the identifier, the class, the record snapshot, references and alias
+    identifiers of a Digital Object. It can be sent to other processes (e.g. through a :mod:`multiprocessing` pool) and 
+    be bound to an infrastructure instance there, typically one created once per process by the pool's initializer. 
+    Binding does not access the infrastructure.
+    """
+    
+    def __init__(self, dobj):
+        """
+        Constructor.
+        
+        :param dobj: The Digital Object to create a handle for.
+        """
+        self.identifier = dobj.identifier
+        self.do_class = type(dobj)
+        self.record = None if dobj._record is None else dict(dobj._record)
+        self.references = dict((k, list(v)) for k, v in dobj._references.iteritems()) if dobj._references else None
+        self.alias_identifiers = dobj.get_alias_identifiers()
+        
+    def bind(self, do_infrastructure):
+        """
+        Reconstructs the Digital Object on the given infrastructure.
+        
+        :param do_infrastructure: The DO infrastructure instance the Digital Object should use.
+        :returns: An instance of the Digital Object's original class.
+        """
+        record = None if self.record is None else dict(self.record)
+        references = dict((k, list(v)) for k, v in self.references.iteritems()) if self.references else None
+        return self.do_class(do_infrastructure, self.identifier, references=references, 
+                             alias_identifiers=list(self.alias_identifiers), record=record)
+
+
 class PropertyNameMismatchError(Exception):
     """
     Exception thrown when trying to assign a value to a property at an index where an existing property of different
@@ -32,7 +32,7 @@ The views and conclusions contained in the software and documentation are those
 of the authors.
 '''
 from lapis.model.do import DigitalObject, PAYLOAD_BITS, MAX_PAYLOAD, SEGMENT_PARENTS_TARGET_MASK_BITS, VALUETYPE_PARENT_OBJECT,\
-    MAX_PARENTS, SEGMENT_PARENTS_MASK_VALUE
+    MAX_PARENTS, SEGMENT_PARENTS_MASK_VALUE, INDEX_RESOURCE_TYPE, VALUETYPE_RESOURCE_TYPE
 
 def split_handle(handle):
     """
@@ -58,12 +58,15 @@ class DigitalObjectArray(DigitalObject):
     VALUETYPE_ARRAY_ELEMENT = "ARRAY_ELEMENT"
     MY_PARENT_SEGMENT_TARGET_MASK = (CHARACTERISTIC_SEGMENT_NUMBER << SEGMENT_PARENTS_TARGET_MASK_BITS) + SEGMENT_PARENTS_MASK_VALUE
 
-    def __init__(self, do_infrastructure, identifier, references = None, alias_identifiers = None):
-        super(DigitalObjectArray, self).__init__(do_infrastructure, identifier, references=references, alias_identifiers=alias_identifiers)
-        self._resource_type = DigitalObjectArray.RESOURCE_TYPE
-        # check and init array size
-        if not self._do_infra._read_pid_value(self._id, self.INDEX_ARRAY_SIZE):
-            self._do_infra._write_pid_value(self._id, self.INDEX_ARRAY_SIZE, self.VALUETYPE_ARRAY_SIZE, 0)
+    __slots__ = ()
+
+    def __init__(self, do_infrastructure, identifier, references = None, alias_identifiers = None, record = None):
+        super(DigitalObjectArray, self).__init__(do_infrastructure, identifier, references=references, alias_identifiers=alias_identifiers, record=record)
+        
+    def _initialize_record(self):
+        # resource type and array size
+        self._do_infra._write_pid_values(self._id, {INDEX_RESOURCE_TYPE: (VALUETYPE_RESOURCE_TYPE, self.RESOURCE_TYPE), 
+                                                    self.INDEX_ARRAY_SIZE: (self.VALUETYPE_ARRAY_SIZE, 0)})
         
     def __modify_size(self, a):
         """
@@ -159,11 +162,10 @@ class DigitalObjectArray(DigitalObject):
             target_id = dobj.identifier
         else:
             target_id = dobj
-        arraysize = self.num_elements()
-        for i in range(0, arraysize):
-            v = self._do_infra._read_pid_value(self._id, self.CATEGORY_MASK_VALUE+i)
-            if v[1] == target_id:
-                return i
+        values = self._do_infra._read_pid_value_range(self._id, self.CATEGORY_MASK_VALUE, self.CATEGORY_MASK_VALUE+MAX_PAYLOAD+1)
+        for index in sorted(values):
+            if values[index][1] == target_id:
+                return index-self.CATEGORY_MASK_VALUE
         raise ValueError("%s is not in this list." % dobj)
         
     def contains(self, dobj):
@@ -176,9 +178,8 @@ class DigitalObjectArray(DigitalObject):
             target_id = dobj.identifier
         else:
             target_id = dobj
-        arraysize = self.num_elements()
-        for i in range(0, arraysize):
-            v = self._do_infra._read_pid_value(self._id, self.CATEGORY_MASK_VALUE+i)
+        values = self._do_infra._read_pid_value_range(self._id, self.CATEGORY_MASK_VALUE, self.CATEGORY_MASK_VALUE+MAX_PAYLOAD+1, cached=True)
+        for v in values.itervalues():
             if v[1] == target_id:
                 return True
         return False
@@ -204,12 +205,15 @@ class DigitalObjectLinkedList(DigitalObject):
     VALUETYPE_PREV_OBJECT = "PREVIOUS_OBJECT"
     VALUETYPE_NEXT_OBJECT = "NEXT_OBJECT"
     
-    def __init__(self, do_infrastructure, identifier, references = None, alias_identifiers = None):
-        super(DigitalObjectLinkedList, self).__init__(do_infrastructure, identifier, references=references, alias_identifiers=alias_identifiers)
-        self._resource_type = self.RESOURCE_TYPE
-        # check and init array size
-        if not self._do_infra._read_pid_value(self._id, self.INDEX_LINKED_LIST_SIZE):
-            self._do_infra._write_pid_value(self._id, self.INDEX_LINKED_LIST_SIZE, self.VALUETYPE_LINKED_LIST_SIZE, 0)
+    __slots__ = ()
+
+    def __init__(self, do_infrastructure, identifier, references = None, alias_identifiers = None, record = None):
+        super(DigitalObjectLinkedList, self).__init__(do_infrastructure, identifier, references=references, alias_identifiers=alias_identifiers, record=record)
+        
+    def _initialize_record(self):
+        # resource type and list size
+        self._do_infra._write_pid_values(self._id, {INDEX_RESOURCE_TYPE: (VALUETYPE_RESOURCE_TYPE, self.RESOURCE_TYPE), 
+                                                    self.INDEX_LINKED_LIST_SIZE: (self.VALUETYPE_LINKED_LIST_SIZE, 0)})
         
     def __modify_size(self, a):
         """
@@ -219,22 +223,13 @@ class DigitalObjectLinkedList(DigitalObject):
         newsize = int(s)+a
         self._do_infra._write_pid_value(self._id, self.INDEX_LINKED_LIST_SIZE, self.VALUETYPE_LINKED_LIST_SIZE, newsize)
         
-    def __find_free_slot(self, dobj):
-        freeslot = 0 
-        while True:
-            v = self._do_infra._read_pid_value(dobj.identifier, self.MY_PARENT_SEGMENT_TARGET_MASK+freeslot)
-            if v:
-                freeslot += 1
-                if v == MAX_PARENTS:
-                    raise Exception("No more free parent slots in %s!" % dobj.identifier)
-                continue
-            break
-        return freeslot
-
     def append_do(self, dobj):
         """
         Appends the given object to the end of the list.
         """
+        # fill in parent info and use free slot to write prev/next references; this comes first since migrating the
+        # parent slots of an old record may move list entries
+        freeslot = dobj._write_parent_info(self)
         # determine last element and its index
         p = self._do_infra._read_pid_value(self.identifier, self.INDEX_LINKED_LIST_LAST_ELEMENT)
         if p:
@@ -243,8 +238,6 @@ class DigitalObjectLinkedList(DigitalObject):
         else:
             last_id = None
             last_id_and_index = ""
-        # fill in parent info and use free slot to write prev/next references
-        freeslot = dobj._write_parent_info(self)
         # cat4: write two entries (previous and next)
         self._do_infra._write_pid_value(dobj.identifier, self.CATEGORY_MASK_VALUE+freeslot*2,   self.VALUETYPE_PREV_OBJECT, last_id_and_index)
         self._do_infra._write_pid_value(dobj.identifier, self.CATEGORY_MASK_VALUE+freeslot*2+1, self.VALUETYPE_NEXT_OBJECT, "")
@@ -271,14 +264,22 @@ class DigitalObjectLinkedList(DigitalObject):
             if not d:
                 raise ValueError("Given object %s is not part of this list %s!" % (index_or_dobj.identifier, self.identifier))
             index_or_dobj = d
+        # fill in parent info and use free slot to write prev/next references; this comes first since migrating the
+        # parent slots of an old record may move list entries
+        dobj_freeslot = dobj._write_parent_info(self)
         # 1a. determine previous element (and at the same time also verify membership in this list)
-        currentindex = self.__determine_first_slot(index_or_dobj.identifier)
+        try:
+            currentindex = self.__determine_first_slot(index_or_dobj.identifier)
+            if currentindex == dobj_freeslot and index_or_dobj.identifier == dobj.identifier:
+                # only found the slot just written
+                raise ValueError("Given object %s is not part of this list %s!" % (index_or_dobj.identifier, self.identifier))
+        except ValueError:
+            dobj._remove_parent_info(self, dobj_freeslot)
+            raise
         poentry = self._do_infra._read_pid_value(index_or_dobj.identifier, self.CATEGORY_MASK_VALUE+currentindex*2)
         if poentry[0] != self.VALUETYPE_PREV_OBJECT:
             raise Exception("Corrupt Linked List element record at %s:%s!" % (self.CATEGORY_MASK_VALUE+currentindex*2, index_or_dobj.identifier))
         prev_dobj_id_and_index = poentry[1]
-        # fill in parent info and use free slot to write prev/next references
-        dobj_freeslot = dobj._write_parent_info(self)
         # now fill in stuff! 
         if prev_dobj_id_and_index:
             # 2a. pred.succ = new_element
@@ -290,11 +291,9 @@ class DigitalObjectLinkedList(DigitalObject):
             prev_dobj_id_and_index = ""
         # 3. index_or_dobj.pred = new_element
         self._do_infra._write_pid_value(index_or_dobj.identifier, self.CATEGORY_MASK_VALUE+currentindex*2, self.VALUETYPE_PREV_OBJECT, "%s:%s" % (self.CATEGORY_MASK_VALUE+dobj_freeslot*2, dobj.identifier))
-        # 4. new_element.parent = self
-        self._do_infra._write_pid_value(dobj.identifier, self.MY_PARENT_SEGMENT_TARGET_MASK+dobj_freeslot, VALUETYPE_PARENT_OBJECT, self.identifier)
-        # 5. new_element.pred = pred
+        # 4. new_element.pred = pred
         self._do_infra._write_pid_value(dobj.identifier, self.CATEGORY_MASK_VALUE+dobj_freeslot*2, self.VALUETYPE_PREV_OBJECT, prev_dobj_id_and_index)
-        # 6. new_element.succ = index_or_dobj
+        # 5. new_element.succ = index_or_dobj
         self._do_infra._write_pid_value(dobj.identifier, self.CATEGORY_MASK_VALUE+dobj_freeslot*2+1, self.VALUETYPE_NEXT_OBJECT, "%s:%s" % (self.CATEGORY_MASK_VALUE+currentindex*2+1, index_or_dobj.identifier))
         self.__modify_size(1)
     
@@ -334,27 +333,41 @@ class DigitalObjectLinkedList(DigitalObject):
             self._do_infra._write_pid_value(pred_dobj, pred_dobj_slot+1, self.VALUETYPE_NEXT_OBJECT, "%s:%s" % (succ_dobj_slot, succ_dobj))
             # 2. succ.pred = dobj.pred
             self._do_infra._write_pid_value(succ_dobj, succ_dobj_slot-1, self.VALUETYPE_PREV_OBJECT, "%s:%s" % (pred_dobj_slot, pred_dobj))
-        # 3. dobj.parent = None
-        self._do_infra._remove_pid_value(dobj.identifier, self.MY_PARENT_SEGMENT_TARGET_MASK+dobj_slot)
-        # 4. dobj.pred = None
-        self._do_infra._remove_pid_value(dobj.identifier, self.CATEGORY_MASK_VALUE+dobj_slot*2)
-        # 5. dobj.succ = None
-        self._do_infra._remove_pid_value(dobj.identifier, self.CATEGORY_MASK_VALUE+dobj_slot*2+1)
+        # 3. dobj.pred = None, dobj.succ = None
+        self._do_infra._remove_pid_values(dobj.identifier, [self.CATEGORY_MASK_VALUE+dobj_slot*2, self.CATEGORY_MASK_VALUE+dobj_slot*2+1])
+        # 4. dobj.parent = None
+        dobj._remove_parent_info(self, dobj_slot)
         self.__modify_size(-1)
         
+    def _member_slot_moved(self, member_dobj, owner_id, from_slot, to_slot):
+        # move PREV and NEXT entries along and update the pointers of the neighbours (or the first/last element
+        # entries of the owning list)
+        prev_entry = self._do_infra._read_pid_value(member_dobj.identifier, self.CATEGORY_MASK_VALUE+from_slot*2)
+        next_entry = self._do_infra._read_pid_value(member_dobj.identifier, self.CATEGORY_MASK_VALUE+from_slot*2+1)
+        self._do_infra._write_pid_values(member_dobj.identifier, {self.CATEGORY_MASK_VALUE+to_slot*2: prev_entry,
+                                                                  self.CATEGORY_MASK_VALUE+to_slot*2+1: next_entry})
+        pred_id, pred_index = split_handle(prev_entry[1])
+        if pred_id:
+            self._do_infra._write_pid_value(pred_id, pred_index+1, self.VALUETYPE_NEXT_OBJECT, "%s:%s" % (self.CATEGORY_MASK_VALUE+to_slot*2+1, member_dobj.identifier))
+        else:
+            self._do_infra._write_pid_value(owner_id, self.INDEX_LINKED_LIST_FIRST_ELEMENT, self.VALUETYPE_LINKED_LIST_FIRST_ELEMENT, "%s:%s" % (self.CATEGORY_MASK_VALUE+to_slot*2+1, member_dobj.identifier))
+        succ_id, succ_index = split_handle(next_entry[1])
+        if succ_id:
+            self._do_infra._write_pid_value(succ_id, succ_index-1, self.VALUETYPE_PREV_OBJECT, "%s:%s" % (self.CATEGORY_MASK_VALUE+to_slot*2, member_dobj.identifier))
+        else:
+            self._do_infra._write_pid_value(owner_id, self.INDEX_LINKED_LIST_LAST_ELEMENT, self.VALUETYPE_LINKED_LIST_LAST_ELEMENT, "%s:%s" % (self.CATEGORY_MASK_VALUE+to_slot*2, member_dobj.identifier))
+        self._do_infra._remove_pid_values(member_dobj.identifier, [self.CATEGORY_MASK_VALUE+from_slot*2, self.CATEGORY_MASK_VALUE+from_slot*2+1])
+        
     def __determine_first_slot(self, identifier):
         """
         Goes through the parent slots on the object with given PID and finds the first one which lists self as the parent.
         :returns: the slot index (not to be confused with the actual Index in the Handle)
         """                    
-        dobj_slot = 0
-        while True:
-            v = self._do_infra._read_pid_value(identifier, self.MY_PARENT_SEGMENT_TARGET_MASK+dobj_slot)
-            if not v or dobj_slot == MAX_PARENTS:
-                raise ValueError("Given object %s is not part of this list %s!" % (identifier, self.identifier))
-            if v[1] == self.identifier:
-                return dobj_slot
-            dobj_slot += 1
+        values = self._do_infra._read_pid_value_range(identifier, self.MY_PARENT_SEGMENT_TARGET_MASK, self.MY_PARENT_SEGMENT_TARGET_MASK+MAX_PARENTS)
+        for index in sorted(values):
+            if values[index][1] == self.identifier:
+                return index-self.MY_PARENT_SEGMENT_TARGET_MASK
+        raise ValueError("Given object %s is not part of this list %s!" % (identifier, self.identifier))
             
     def get_do_and_slotindex(self, index):
         """
@@ -388,16 +401,11 @@ class DigitalObjectLinkedList(DigitalObject):
             dobj_id = dobj.identifier
         else:
             dobj_id = dobj
-        i = 0
-        while True:
-            v = self._do_infra._read_pid_value(dobj_id, self.MY_PARENT_SEGMENT_TARGET_MASK+i)
-            if not v:
-                return False
+        values = self._do_infra._read_pid_value_range(dobj_id, self.MY_PARENT_SEGMENT_TARGET_MASK, self.MY_PARENT_SEGMENT_TARGET_MASK+MAX_PARENTS, cached=True)
+        for v in values.itervalues():
             if v[1] == self.identifier:
                 return True
-            i += 1
-            if i == MAX_PARENTS:
-                return False
+        return False
     
     def index_of(self, dobj):
         """
@@ -29,7 +29,17 @@ SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 The views and conclusions contained in the software and documentation are those
 of the authors.
 '''
-from lapis.model.do import DigitalObject, REFERENCE_SUBELEMENT_OF
+from lapis.model.do import DigitalObject, REFERENCE_SUBELEMENT_OF, INDEX_RESOURCE_TYPE, VALUETYPE_RESOURCE_TYPE, DEFAULT_WORKERS
+from lapis.model.bloomfilter import BloomFilter, DEFAULT_CAPACITY, DEFAULT_ERROR_RATE
+from contextlib import contextmanager
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+"""
+Record Index (plus the characteristic segment number) of the optional Bloom filter summarizing the members of a set.
+"""
+BASE_INDEX_MEMBER_FILTER = 4200
+VALUETYPE_MEMBER_FILTER = "MEMBER_FILTER"
 
 class DigitalObjectSet(DigitalObject):
     '''
@@ -42,58 +52,229 @@ class DigitalObjectSet(DigitalObject):
     RESOURCE_TYPE = "DIGITAL_OBJECT_SET"
     CHARACTERISTIC_SEGMENT_NUMBER = 3
     
+    __slots__ = ("__hashmap", "__has_filter")
+    
     class SetIterator(object):
         
         def __init__(self, doset, hashiter):
             self.__doset = doset
             self.__hashiter = hashiter
             
+        def __iter__(self):
+            return self
+            
         def next(self):
-            index, vt, v = self.__hashiter.next()
-            dobj = self.__doset.infrastructure.resolve_pid(v)
+            index, v = self.__hashiter.next()
+            dobj = self.__doset.infrastructure.lookup_pid(v[1])
             return dobj
     
-    def __init__(self, do_infrastructure, identifier, references = None, alias_identifiers = None):
-        super(DigitalObjectSet, self).__init__(do_infrastructure, identifier, references = references, alias_identifiers=alias_identifiers)
-        self._resource_type = DigitalObjectSet.RESOURCE_TYPE
-        self.__hashmap = self._do_infra.manufacture_hashmap(self._id, self.CHARACTERISTIC_SEGMENT_NUMBER)
+    def __init__(self, do_infrastructure, identifier, references = None, alias_identifiers = None, record = None):
+        super(DigitalObjectSet, self).__init__(do_infrastructure, identifier, references = references, alias_identifiers=alias_identifiers, record=record)
+        self.__hashmap = self._do_infra.manufacture_hashmap(self._id, self.CHARACTERISTIC_SEGMENT_NUMBER, record)
+        # None if unknown whether the record holds a member filter
+        self.__has_filter = None if record is None else (BASE_INDEX_MEMBER_FILTER+self.CHARACTERISTIC_SEGMENT_NUMBER) in record
+        
+    def _initialize_record(self):
+        # resource type and hash map values in one request
+        values = self.__hashmap.initial_values()
+        values[INDEX_RESOURCE_TYPE] = (VALUETYPE_RESOURCE_TYPE, DigitalObjectSet.RESOURCE_TYPE)
+        self._do_infra._write_pid_values(self._id, values)
+        self.__has_filter = False
+                
+    def load_members(self):
+        """
+        Reads all members of this set in a single operation. Until :meth:`unload_members` is called, membership checks 
+        and modifications work on a local copy, so they do not cost any requests for probing the underlying hash map. 
+        Modifications are written in one batch when unloading. Changes made by other clients meanwhile are not noticed.
+        Note that parent information on added or removed members is still written immediately.
+        """
+        self.__hashmap.load_segment()
+        
+    def unload_members(self):
+        """
+        Writes all modifications made since :meth:`load_members` and discards the local copy of the members.
+        """
+        self.__hashmap.unload_segment()
+        
+    @contextmanager
+    def __members_loaded(self):
+        # operations on lists of objects load the members temporarily if they are not loaded yet
+        if self.__hashmap.is_segment_loaded():
+            yield
+            return
+        self.__hashmap.load_segment()
+        try:
+            yield
+        finally:
+            self.__hashmap.unload_segment()
                 
-    def add_do(self, dobj):
+    def add_do(self, dobj, workers=DEFAULT_WORKERS):
         """
         Adds one or more Digital Objects to the set.
         
+        If a list is given, the set's own record is updated in a single batch (or a few large ones for new sets), and 
+        the parent information of the members is written concurrently. Objects already in the set are skipped.
+        
         :param dobj: Either a DO instance or a list of DO instances.  
+        :param workers: Number of member records updated concurrently if a list is given.
         """
         if isinstance(dobj, list):
-            for x in dobj:
-                if not isinstance(x, DigitalObject):
-                    raise ValueError("The given list contains objects that are no Digital Object instances!")
-                self.__hashmap.set(x.identifier, x.identifier)
-                x._write_parent_info(self)
+            members = self.__unique_members(dobj)
+            if self.__hashmap.is_segment_loaded() or self.__hashmap.size() > 0:
+                with self.__members_loaded():
+                    members = [x for x in members if not self.__hashmap.contains(x.identifier)]
+                    self.__hashmap.bulk_set((x.identifier, x.identifier) for x in members)
+            else:
+                self.__hashmap.bulk_set((x.identifier, x.identifier) for x in members)
+            self.__update_member_filter(added=[x.identifier for x in members])
+            self.__update_members(members, lambda x: x._write_parent_info(self), workers)
         else:
             if not isinstance(dobj, DigitalObject):
                 raise ValueError("The given object is not a Digital Object instance: %s" % dobj)
             self.__hashmap.set(dobj.identifier, dobj.identifier)
+            self.__update_member_filter(added=[dobj.identifier])
             dobj._write_parent_info(self)
     
-    def remove_do(self, dobj_or_index):
+    def remove_do(self, dobj_or_index, workers=DEFAULT_WORKERS):
         """
         Removes the given Digital Object(s) from the set.
         
+        If a list is given, the set's own record is updated in a single batch, and the parent information of the 
+        members is removed concurrently.
+        
         :param dobj_or_index: Either a DO instance or a list of DO instances.
+        :param workers: Number of member records updated concurrently if a list is given.
         """
         if isinstance(dobj_or_index, list):
-            for x in dobj_or_index:
-                if not isinstance(x, DigitalObject):
-                    raise ValueError("The given list contains objects that are no Digital Object instances!")
-                self.__hashmap.remove(x.identifier)
-                x._remove_parent_info(self)
+            members = self.__unique_members(dobj_or_index)
+            with self.__members_loaded():
+                for x in members:
+                    self.__hashmap.remove(x.identifier)
+            self.__update_member_filter(removed=len(members))
+            self.__update_members(members, lambda x: x._remove_parent_info(self), workers)
         else:
             if not isinstance(dobj_or_index, DigitalObject):
                 raise ValueError("The given object is not a Digital Object instance: %s" % dobj_or_index)
             self.__hashmap.remove(dobj_or_index.identifier)
+            self.__update_member_filter(removed=1)
             dobj_or_index._remove_parent_info(self)
+            
+    def __unique_members(self, dobjs):
+        members = []
+        seen = set()
+        for x in dobjs:
+            if not isinstance(x, DigitalObject):
+                raise ValueError("The given list contains objects that are no Digital Object instances!")
+            if x.identifier not in seen:
+                seen.add(x.identifier)
+                members.append(x)
+        return members
+            
+    def __update_members(self, members, update, workers):
+        # each member record is touched by exactly one call, so they can be updated concurrently
+        if workers <= 1 or len(members) <= 1:
+            for x in members:
+                update(x)
+            return
+        pool = ThreadPool(min(workers, len(members)))
+        try:
+            pool.map(update, members)
+        finally:
+            pool.close()
+            pool.join()
     
+    def enable_member_filter(self, capacity=DEFAULT_CAPACITY, error_rate=DEFAULT_ERROR_RATE):
+        """
+        Stores a Bloom filter summarizing the current members in the set's record, replacing any existing one. From 
+        then on, :meth:`add_do` and :meth:`remove_do` update the filter at the cost of one additional read and write 
+        each. The filter only grows: removing a member does not clear its bits, so removed members remain false 
+        positives until the filter is rebuilt. It is rebuilt automatically once it has become too full or too many 
+        members were removed, and can be rebuilt at any time by calling this method again. Clients can use 
+        :meth:`might_contain` to reject non-members with a single small read.
+        
+        The filter is updated by reading and rewriting it. If several clients modify the set concurrently, one client's
+        update may overwrite another's, so members may be missing from the filter; call this method again after such 
+        concurrent modifications.
+        
+        :param capacity: Number of members the filter is sized for. Raised to the current number of members if lower.
+        :param error_rate: Intended false positive rate at full capacity.
+        """
+        self.__write_member_filter(self.__build_member_filter(capacity, error_rate))
+        
+    def disable_member_filter(self):
+        """
+        Removes the member filter from the set's record. Does nothing if there is none.
+        """
+        self._do_infra._remove_pid_value(self._id, self.__member_filter_index())
+        self.__has_filter = False
+        
+    def has_member_filter(self):
+        """
+        Returns True if the set's record holds a member filter.
+        """
+        if self.__has_filter is None:
+            self.__has_filter = self.__read_member_filter() is not None
+        return self.__has_filter
+        
+    def might_contain(self, dobj):
+        """
+        Checks whether the given object may be a member of the set. If the set has a member filter, only the filter is 
+        read, and the answer may be a false positive, e.g. for members removed since the filter was last rebuilt. If 
+        the answer is False, the object is no member, provided the filter was not missed by concurrent updates (see 
+        :meth:`enable_member_filter`). Without a member filter, the underlying hash map is probed and the answer is 
+        exact.
+        
+        :param dobj: A DO instance or an identifier string.
+        :return: True or False.
+        """
+        if isinstance(dobj, DigitalObject):
+            pid = dobj.identifier
+        elif isinstance(dobj, basestring):
+            pid = dobj
+        else:
+            raise ValueError("The given object is neither a Digital Object instance nor an identifier: %s" % dobj)
+        if self.__has_filter is not False:
+            bf = self.__read_member_filter()
+            if bf is not None:
+                return bf.might_contain(pid)
+        return self.__hashmap.contains(pid)
+        
+    def __member_filter_index(self):
+        return BASE_INDEX_MEMBER_FILTER+self.CHARACTERISTIC_SEGMENT_NUMBER
+        
+    def __read_member_filter(self):
+        v = self._do_infra._read_pid_value(self._id, self.__member_filter_index())
+        self.__has_filter = bool(v)
+        if not v:
+            return None
+        return BloomFilter.from_string(v[1])
+    
+    def __write_member_filter(self, bf):
+        self._do_infra._write_pid_value(self._id, self.__member_filter_index(), VALUETYPE_MEMBER_FILTER, bf.to_string())
+        self.__has_filter = True
+        
+    def __build_member_filter(self, capacity, error_rate):
+        pids = list(self.iter_pids())
+        bf = BloomFilter.for_capacity(max(capacity, len(pids)), error_rate)
+        for pid in pids:
+            bf.add(pid)
+        return bf
+        
+    def __update_member_filter(self, added=(), removed=0):
+        # the filter is read anew for every update to pick up earlier updates; concurrent updates may still overwrite each other
+        if self.__has_filter is False or (not added and not removed):
+            return
+        bf = self.__read_member_filter()
+        if bf is None:
+            return
+        for pid in added:
+            bf.add(pid)
+        bf.note_removed(removed)
+        if bf.needs_rebuild():
+            # grow the filter if it is full; the false positive rate at capacity is kept
+            bf = self.__build_member_filter(max(bf.capacity, 2 * self.__hashmap.size()), bf.error_rate())
+        self.__write_member_filter(bf)
+        
     def contains_do(self, dobj):
         """
         Check if the set contains the given Digital Object(s).
@@ -105,24 +286,137 @@ class DigitalObjectSet(DigitalObject):
             for x in dobj:
                 if not isinstance(x, DigitalObject):
                     raise ValueError("The given list contains objects that are no Digital Object instances!")
-                if not self.__hashmap.contains(x.identifier):
-                    return False
-            return True
+            return all(self.membership_mask(dobj))
         else:
             if not isinstance(dobj, DigitalObject):
                 raise ValueError("The given object is not a Digital Object instance: %s" % dobj)
             return self.__hashmap.contains(dobj.identifier)
+        
+    def membership_mask(self, items):
+        """
+        Checks for many objects at once whether they are members of this set. The set's record is read only once, 
+        regardless of the number of objects.
+        
+        :param items: A list of DO instances or identifier strings (may be mixed).
+        :return: a list of booleans, one for each given item in the same order.
+        """
+        pids = []
+        for x in items:
+            if isinstance(x, DigitalObject):
+                pids.append(x.identifier)
+            elif isinstance(x, basestring):
+                pids.append(x)
+            else:
+                raise ValueError("The given list contains objects that are neither Digital Object instances nor identifiers: %s" % x)
+        if not pids:
+            return []
+        return self.__hashmap.contains_keys(pids)
+
+    def iter_pids(self):
+        """
+        Iterate over the identifiers of the members of the set without resolving them. The set's record is read once.
+        
+        :return: an iterator over identifier strings
+        """
+        for idx, v in self.__hashmap:
+            yield v[1]
 
-    def iter_set_elements(self):
+    def iter_set_elements(self, prefetch=0, workers=DEFAULT_WORKERS):
         """
         Iterate over the _elements in the Digital Object set.
         
+        :param prefetch: If greater than 0, members are resolved concurrently up to this many elements ahead of the 
+          consumer. At most this many resolved members are held at a time.
+        :param workers: Number of members resolved concurrently if prefetching.
         :return: an iterator object
         """
-        for idx, v in self.__hashmap:
-            dobj = self._do_infra.lookup_pid(v[1])
-            yield dobj
+        if prefetch <= 0 or workers <= 1:
+            for pid in self.iter_pids():
+                yield self._do_infra.lookup_pid(pid)
+            return
+        pool = ThreadPool(min(workers, prefetch))
+        try:
+            pending = deque()
+            for pid in self.iter_pids():
+                pending.append(pool.apply_async(self._do_infra.lookup_pid, (pid,)))
+                if len(pending) >= prefetch:
+                    yield pending.popleft().get()
+            while pending:
+                yield pending.popleft().get()
+        finally:
+            pool.close()
+            pool.join()
     
+    def __pid_set(self, other):
+        if isinstance(other, DigitalObjectSet):
+            return set(other.iter_pids())
+        return set(other)
+
+    def union(self, *others):
+        """
+        Computes the union of this set and the given sets. Each set's record is read once; no member is resolved.
+
+        :param others: DigitalObjectSet instances or iterables of identifier strings.
+        :return: a Python set of member identifiers. Use :meth:`materialize` to store it as a new Digital Object set.
+        """
+        result = set(self.iter_pids())
+        for other in others:
+            result.update(self.__pid_set(other))
+        return result
+
+    def intersection(self, *others):
+        """
+        Computes the intersection of this set and the given sets. Each set's record is read once; no member is
+        resolved.
+
+        :param others: DigitalObjectSet instances or iterables of identifier strings.
+        :return: a Python set of member identifiers.
+        """
+        result = set(self.iter_pids())
+        for other in others:
+            result.intersection_update(self.__pid_set(other))
+        return result
+
+    def difference(self, *others):
+        """
+        Computes the members of this set that are not members of any of the given sets. Each set's record is read
+        once; no member is resolved.
+
+        :param others: DigitalObjectSet instances or iterables of identifier strings.
+        :return: a Python set of member identifiers.
+        """
+        result = set(self.iter_pids())
+        for other in others:
+            result.difference_update(self.__pid_set(other))
+        return result
+
+    def is_subset(self, other):
+        """
+        Checks whether every member of this set is also a member of the given set.
+
+        :param other: A DigitalObjectSet instance or an iterable of identifier strings.
+        :return: True or False.
+        """
+        return set(self.iter_pids()).issubset(self.__pid_set(other))
+
+    @classmethod
+    def materialize(cls, do_infrastructure, pids, identifier=None, workers=DEFAULT_WORKERS):
+        """
+        Creates a new Digital Object set with the given members, e.g. the result of :meth:`union`. The members are
+        added in bulk (see :meth:`add_do`) without resolving them.
+
+        :param do_infrastructure: The infrastructure to create the set in.
+        :param pids: An iterable of member identifier strings.
+        :param identifier: The identifier of the new set. If None, a random identifier is used.
+        :param workers: Number of member records updated concurrently.
+        :return: the new DigitalObjectSet instance.
+        """
+        doset = do_infrastructure.create_do(identifier, cls)
+        members = [DigitalObject(do_infrastructure, pid) for pid in pids]
+        if members:
+            doset.add_do(members, workers=workers)
+        return doset
+
     def num_set_elements(self):
         """
         Returns the number of set member elements.
@@ -131,6 +425,20 @@ class DigitalObjectSet(DigitalObject):
         """
         return self.__hashmap.size()
     
+    def rehash_members(self):
+        """
+        Migrates the underlying hash map of a set created by an earlier version to the current, process-independent 
+        hash function. Sets created by earlier versions can only be used reliably from the same interpreter version.
+        """
+        self.__hashmap.rehash()
+        
+    def probe_statistics(self):
+        """
+        Returns statistics on the probe lengths of the underlying hash map, see 
+        :meth:`lapis.model.hashmap.HandleHashmapImpl.probe_statistics`.
+        """
+        return self.__hashmap.probe_statistics()
+    
     def __iter__(self):
         return self.iter_set_elements()    
     
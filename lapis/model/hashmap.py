@@ -4,14 +4,71 @@ Created on 17.04.2013
 @author: tobiasweigel
 '''
 import sys
+import struct
+import hashlib
 import logging
-from lapis.model.do import PAYLOAD_BITS
+from lapis.model.do import PAYLOAD_BITS, SIZE_STRATEGY_DERIVED, VALUETYPE_DERIVED_SIZE
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 logger = logging.getLogger(__name__)
 
 HASHMASK = 2**PAYLOAD_BITS-1
 VALUETYPE_HASHMAP_SIZE = "HASHMAP_SIZE"
 BASE_INDEX_HASHMAP_SIZE = 4000
+VALUETYPE_HASHMAP_VERSION = "HASHMAP_VERSION"
+BASE_INDEX_HASHMAP_VERSION = 4100
+
+"""
+Hash map format versions. Hash maps without a version marker use Python's built-in hash function, which differs 
+between processes and interpreter versions. Newer hash maps use a hash function derived from MD5.
+"""
+HASHMAP_VERSION_BUILTIN_HASH = 1
+HASHMAP_VERSION_STABLE_HASH = 2
+
+"""
+Default number of buckets written in a single request by bulk loading.
+"""
+DEFAULT_BULK_BATCH_SIZE = 1000
+
+
+def plan_bucket_positions(homes):
+    """
+    Computes the bucket positions of entries inserted into an empty hash map with linear probing, given their home
+    buckets in ascending order. The resulting layout is the one Robin Hood insertion produces: each entry is stored 
+    in its home bucket or the first bucket after its predecessor, whichever is higher. Uses NumPy if it is available.
+    
+    :param homes: A list of home bucket numbers, sorted ascending.
+    :returns: A list of bucket numbers in the same order. Positions may exceed the hash map's bucket range.
+    """
+    if numpy is not None:
+        h = numpy.asarray(homes, dtype=numpy.int64)
+        offsets = numpy.arange(len(h), dtype=numpy.int64)
+        return (numpy.maximum.accumulate(h - offsets) + offsets).tolist()
+    positions = []
+    last = None
+    for home in homes:
+        if last is not None and home <= last:
+            home = last + 1
+        positions.append(home)
+        last = home
+    return positions
+
+
+def stable_hash(key):
+    """
+    Process-independent hash function for hash map keys.
+    
+    :param key: A string.
+    :returns: A non-negative 32 bit int.
+    """
+    if isinstance(key, unicode):
+        key = key.encode("utf-8")
+    return struct.unpack("<I", hashlib.md5(key).digest()[:4])[0]
+
 
 class Hashmap(object):
     '''
@@ -40,93 +97,399 @@ class Hashmap(object):
     
     
 class HandleHashmapImpl(Hashmap):
+    """
+    Hash map stored in an Index segment of a Handle record, using linear probing.
+    
+    By default, every probe reads a single bucket from the infrastructure. Alternatively, the whole segment can be
+    loaded with :meth:`load_segment`; the hash map then probes its local mirror of the segment and writes back only the
+    changed buckets and the size, in one batch on :meth:`flush` or :meth:`unload_segment`. Changes made by other clients 
+    while the segment is loaded are not noticed.
+    """
     
-    def __init__(self, infrastructure, identifier, segment_number):
+    def __init__(self, infrastructure, identifier, segment_number, record=None):
         """
         Constructor.
         
         :param: segment_number: This hash map implementation is designed so that one Handle Record can contain several
           independent hash maps. The segment number is used to separate the corresponding Index segments from each other. 
           Typically, this is the "characteristic segment number" of a collection type.          
+        :param: record: A snapshot of the record holding the hash map, if available. Used to determine the format 
+          version and size strategy without reading them from the record.
         """
         super(HandleHashmapImpl, self).__init__(infrastructure)
         self._id = identifier
         self._segment_number = segment_number
         self._index_hashmap_size = BASE_INDEX_HASHMAP_SIZE+segment_number
-        if not self._infra._read_pid_value(self._id, self._index_hashmap_size):
-            self._infra._write_pid_value(self._id, self._index_hashmap_size, VALUETYPE_HASHMAP_SIZE, 0)
+        self._index_hashmap_version = BASE_INDEX_HASHMAP_VERSION+segment_number
+        self._version = None
+        self._derived_size = None
+        if record is not None:
+            self.__set_version(record.get(self._index_hashmap_version))
+            self.__set_size_strategy(record.get(self._index_hashmap_size))
+        self._mirror = None
+        self._mirror_size = None
+        self._changed_indices = None
+        self._stored_indices = None
+        
+    def initialize(self):
+        """
+        Writes the initial values of a new, empty hash map to the record.
+        """
+        self._infra._write_pid_values(self._id, self.initial_values())
+        
+    def initial_values(self):
+        """
+        Returns the initial values of a new, empty hash map as a dict of index: (type, value), so callers can write
+        them together with other values of a new record. This instance assumes that they will be written.
+        """
+        if self._infra._collection_size_strategy == SIZE_STRATEGY_DERIVED:
+            size_value = (VALUETYPE_DERIVED_SIZE, "")
+        else:
+            size_value = (VALUETYPE_HASHMAP_SIZE, 0)
+        self._version = HASHMAP_VERSION_STABLE_HASH
+        self.__set_size_strategy(size_value)
+        return {self._index_hashmap_size: size_value,
+                self._index_hashmap_version: (VALUETYPE_HASHMAP_VERSION, HASHMAP_VERSION_STABLE_HASH)}
+        
+    def __set_size_strategy(self, v):
+        self._derived_size = bool(v) and v[0] == VALUETYPE_DERIVED_SIZE
+        
+    def __set_version(self, v):
+        if v:
+            self._version = int(v[1])
+        else:
+            self._version = HASHMAP_VERSION_BUILTIN_HASH
+        
+    def _get_version(self):
+        if self._version is None:
+            self.__set_version(self._infra._read_pid_value(self._id, self._index_hashmap_version))
+        return self._version
+    
+    version = property(_get_version, doc="The format version of this hash map (read-only).")
+        
+    def load_segment(self):
+        """
+        Reads the whole hash map segment and its size in a single operation. Until :meth:`unload_segment` is called, 
+        all operations work on the local mirror. Reloads the segment if it is already loaded, discarding unflushed
+        changes.
+        """
+        lo, hi = self._segment_bounds()
+        record = self._infra._read_all_pid_values(self._id)
+        self._mirror = dict((idx, v) for idx, v in record.iteritems() if lo <= idx < hi)
+        self.__set_version(record.get(self._index_hashmap_version))
+        v = record.get(self._index_hashmap_size)
+        self.__set_size_strategy(v)
+        if self._derived_size:
+            self._mirror_size = len(self._mirror)
+        else:
+            self._mirror_size = int(v[1]) if v else 0
+        self._changed_indices = set()
+        # buckets present in the record; only these need to be removed on flush
+        self._stored_indices = set(self._mirror)
+        
+    def is_segment_loaded(self):
+        """
+        Returns True if the hash map works on a local mirror of its segment.
+        """
+        return self._mirror is not None
+        
+    def flush(self):
+        """
+        Writes all changes made to the local mirror to the infrastructure: one batch for changed buckets and the size, 
+        one for removed buckets. Does nothing if the segment is not loaded. Buckets that were both created and removed 
+        since the last flush are not sent at all. If a request fails, the changes are kept, so a later flush sends them
+        again.
+        """
+        if self._mirror is None or not self._changed_indices:
+            return
+        # the size is written along with the buckets; only bucket changes can change the size
+        values = {}
+        removed = []
+        for idx in self._changed_indices:
+            if idx in self._mirror:
+                values[idx] = self._mirror[idx]
+            elif idx in self._stored_indices:
+                removed.append(idx)
+        if not self._derived_size:
+            values[self._index_hashmap_size] = (VALUETYPE_HASHMAP_SIZE, self._mirror_size)
+        self._infra._write_pid_values(self._id, values)
+        if removed:
+            self._infra._remove_pid_values(self._id, sorted(removed))
+        self._stored_indices = set(self._mirror)
+        self._changed_indices = set()
+        
+    def unload_segment(self):
+        """
+        Flushes all changes and discards the local mirror. Subsequent operations access the infrastructure directly.
+        """
+        self.flush()
+        self._mirror = None
+        self._mirror_size = None
+        self._changed_indices = None
+        self._stored_indices = None
+        
+    def __read_bucket(self, h):
+        if self._mirror is not None:
+            return self._mirror.get(h)
+        return self._infra._read_pid_value(self._id, h)
+    
+    def __write_bucket(self, h, key, value):
+        if self._mirror is not None:
+            self._mirror[h] = (key, value)
+            self._changed_indices.add(h)
+        else:
+            self._infra._write_pid_value(self._id, h, key, value)
+            
+    def __remove_bucket(self, h):
+        if self._mirror is not None:
+            del self._mirror[h]
+            self._changed_indices.add(h)
+        else:
+            self._infra._remove_pid_value(self._id, h)
         
     def __prepare_hash(self, key):
-        return (hash(key) & HASHMASK) + (self._segment_number << PAYLOAD_BITS)
+        if self._get_version() >= HASHMAP_VERSION_STABLE_HASH:
+            h = stable_hash(key)
+        else:
+            h = hash(key)
+        return (h & HASHMASK) + (self._segment_number << PAYLOAD_BITS)
+    
+    def bulk_set(self, items, batch_size=DEFAULT_BULK_BATCH_SIZE):
+        """
+        Sets many entries at once. If the hash map is empty and uses the current format version, the complete bucket 
+        layout is planned locally and written in batches of given size, the last one including the size. Otherwise, the
+        entries are set one by one on a local mirror of the segment, which is written in one batch afterwards. 
+        
+        :param items: An iterable of (key, value) tuples. If a key occurs more than once, its last value is used.
+        :param batch_size: Maximum number of buckets written in a single request.
+        """
+        entries = dict(items)
+        if self._get_version() < HASHMAP_VERSION_STABLE_HASH or self.size() > 0:
+            self.__bulk_set_mirrored(entries)
+            return
+        lo, hi = self._segment_bounds()
+        planned = sorted((self.__prepare_hash(key), key) for key in entries)
+        positions = plan_bucket_positions([home for home, key in planned])
+        if positions and positions[-1] >= hi:
+            # entries would wrap around the end of the segment; very unlikely, so use the general way
+            self.__bulk_set_mirrored(entries)
+            return
+        values = [(pos, (key, entries[key])) for pos, (home, key) in zip(positions, planned)]
+        for i in range(0, len(values), batch_size):
+            batch = dict(values[i:i+batch_size])
+            if i + batch_size >= len(values) and not self._derived_size:
+                batch[self._index_hashmap_size] = (VALUETYPE_HASHMAP_SIZE, len(values))
+            self._infra._write_pid_values(self._id, batch)
+        if self._mirror is not None:
+            self._mirror.update(values)
+            self._mirror_size = len(values)
+            self._stored_indices.update(pos for pos, v in values)
+            
+    def __bulk_set_mirrored(self, entries):
+        loaded = self.is_segment_loaded()
+        if not loaded:
+            self.load_segment()
+        for key, value in entries.iteritems():
+            self.set(key, value)
+        if not loaded:
+            self.unload_segment()
+        
+    def rehash(self):
+        """
+        Migrates a hash map to the current format version by re-inserting all entries with the current hash function. 
+        All changed buckets are written in one batch. Does nothing if the hash map already has the current version.
+        """
+        if self._get_version() == HASHMAP_VERSION_STABLE_HASH:
+            return
+        loaded = self.is_segment_loaded()
+        if not loaded:
+            self.load_segment()
+        entries = self._mirror.values()
+        for idx in self._mirror.keys():
+            self.__remove_bucket(idx)
+        self._mirror_size = 0
+        self._version = HASHMAP_VERSION_STABLE_HASH
+        for key, value in entries:
+            self.set(key, value)
+        self.flush()
+        self._infra._write_pid_value(self._id, self._index_hashmap_version, VALUETYPE_HASHMAP_VERSION, HASHMAP_VERSION_STABLE_HASH)
+        if not loaded:
+            self.unload_segment()
+            
+    def probe_statistics(self):
+        """
+        Determines how many probes are needed to find the entries of this hash map.
+        
+        :returns: A dict with keys "entries" (number of entries), "mean" (mean probe count) and "max" (maximum probe
+          count). A probe count of 1 means the entry is stored in its home bucket.
+        """
+        lo, hi = self._segment_bounds()
+        probes = []
+        for idx, (key, value) in self:
+            home = self.__prepare_hash(key)
+            probes.append((idx - home) % (hi - lo) + 1)
+        if not probes:
+            return {"entries": 0, "mean": 0.0, "max": 0}
+        return {"entries": len(probes), "mean": float(sum(probes)) / len(probes), "max": max(probes)}
+    
+    def __next_index(self, h):
+        # linear probing, wrapping around at the end of the segment
+        h += 1
+        if h > ((self._segment_number+1) << PAYLOAD_BITS) - 1:
+            h = self._segment_number << PAYLOAD_BITS
+        return h
+    
+    def __probe_distance(self, h, key):
+        # number of buckets between the home bucket of key and h
+        return (h - self.__prepare_hash(key)) % (HASHMASK+1)
     
     def set(self, key, value):
-        # hash key and truncate to positive 32 bit int
+        if self._get_version() < HASHMAP_VERSION_STABLE_HASH:
+            return self.__set_linear(key, value)
+        # Robin Hood insertion: an entry further away from its home bucket takes the bucket of an entry closer to its
+        # home, which is then inserted further on. Keeps probe sequences short and allows lookups to terminate early.
+        h = self.__prepare_hash(key)
+        dist = 0
+        current = (key, value)
+        displaced = False
+        while True:
+            bucket = self.__read_bucket(h)
+            if not bucket:
+                self.__write_bucket(h, current[0], current[1])
+                self.__modify_size(1)
+                return
+            if not displaced and bucket[0] == key:
+                self.__write_bucket(h, key, value)
+                return
+            bucket_dist = self.__probe_distance(h, bucket[0])
+            if bucket_dist < dist:
+                # key cannot be further on, so this is a new entry
+                self.__write_bucket(h, current[0], current[1])
+                current = bucket
+                dist = bucket_dist
+                displaced = True
+            h = self.__next_index(h)
+            dist += 1
+            
+    def __set_linear(self, key, value):
+        # hash maps using the built-in hash are not ordered, so insertion uses plain linear probing
         h = self.__prepare_hash(key)
-        # look at bucket
-        bucket = self._infra._read_pid_value(self._id, h)
-        while bucket and bucket[0] is not key:
-            # simple linear probing
-            h += 1
-            if h > ((self._segment_number+1) << PAYLOAD_BITS) - 1:
-                # set to beginning of hash block
-                h = self._segment_number << PAYLOAD_BITS
-            bucket = self._infra._read_pid_value(self._id, h)
-        self._infra._write_pid_value(self._id, h, key, value)
+        bucket = self.__read_bucket(h)
+        while bucket and bucket[0] != key:
+            h = self.__next_index(h)
+            bucket = self.__read_bucket(h)
+        self.__write_bucket(h, key, value)
         if not bucket:
             self.__modify_size(1)
-        
-    def get(self, key):
-        # hash key and truncate to positive 32 bit int
+            
+    def __find(self, key):
+        """
+        Returns the index of the bucket holding key or None if there is no such bucket.
+        """
+        robin_hood = self._get_version() >= HASHMAP_VERSION_STABLE_HASH
         h = self.__prepare_hash(key)
-        # look at bucket
-        bucket = None
+        dist = 0
         while True:
-            bucket = self._infra._read_pid_value(self._id, h)
+            bucket = self.__read_bucket(h)
             if not bucket:
                 return None
             if bucket[0] == key:
-                return bucket[1]
-            h += 1
-            if h > ((self._segment_number+1) << PAYLOAD_BITS) - 1:
-                h = self._segment_number << PAYLOAD_BITS
+                return h
+            if robin_hood and self.__probe_distance(h, bucket[0]) < dist:
+                # key would have displaced this entry
+                return None
+            h = self.__next_index(h)
+            dist += 1
+        
+    def get(self, key):
+        h = self.__find(key)
+        if h is None:
+            return None
+        return self.__read_bucket(h)[1]
     
     def contains(self, key):
         return self.get(key) is not None
     
+    def contains_keys(self, keys):
+        """
+        Checks membership of many keys at once. The segment is read in a single operation (or taken from the local 
+        mirror if loaded) instead of probing for every key.
+        
+        :param keys: An iterable of keys.
+        :returns: a list of booleans, one for each key in the given order.
+        """
+        stored = set(v[0] for idx, v in self)
+        return [key in stored for key in keys]
+    
     def remove(self, key):
-        # hash key and truncate to positive 32 bit int
-        h = self.__prepare_hash(key)
-        # look at bucket
-        bucket = None
+        h = self.__find(key)
+        if h is None:
+            return
+        # close the gap so that no probe sequence is interrupted; entries are moved into the hole one by one and only 
+        # the final hole is removed
+        robin_hood = self._get_version() >= HASHMAP_VERSION_STABLE_HASH
+        hole = h
+        h = self.__next_index(h)
         while True:
-            bucket = self._infra._read_pid_value(self._id, h)
+            bucket = self.__read_bucket(h)
             if not bucket:
-                return 
-            if bucket[0] == key:
-                # found it; now remove handle value
-                self._infra._remove_pid_value(self._id, h)
-                self.__modify_size(-1)
-                return 
-            h += 1
-            if h > ((self._segment_number+1) << PAYLOAD_BITS) - 1:
-                h = self._segment_number << PAYLOAD_BITS
+                break
+            dist = self.__probe_distance(h, bucket[0])
+            if robin_hood and dist == 0:
+                # backward shift ends at the first entry in its home bucket
+                break
+            # without Robin Hood ordering, only entries whose home bucket is not after the hole may be moved into it
+            if robin_hood or dist >= (h - hole) % (HASHMASK+1):
+                self.__write_bucket(hole, bucket[0], bucket[1])
+                hole = h
+            h = self.__next_index(h)
+        self.__remove_bucket(hole)
+        self.__modify_size(-1)
+                
+    def _segment_bounds(self):
+        """
+        Returns the interval of Handle record Indexes occupied by this hash map as a (lo, hi) tuple, hi excluded.
+        """
+        return (self._segment_number << PAYLOAD_BITS, (self._segment_number+1) << PAYLOAD_BITS)
                 
     def is_map_index(self, index):
         """
         Verifies whether a given Handle record Index is part of this hash map.            
         """
-        return (self._segment_number << PAYLOAD_BITS) <= index < ((self._segment_number+1) << PAYLOAD_BITS)  
+        lo, hi = self._segment_bounds()
+        return lo <= index < hi
     
     def __iter__(self):
-        cached_values = self._infra._read_all_pid_values(self._id)
-        for idx, v in cached_values.iteritems():
-            if self.is_map_index(idx):
-                yield (idx, v)
+        if self._mirror is not None:
+            values = dict(self._mirror)
+        else:
+            lo, hi = self._segment_bounds()
+            values = self._infra._read_pid_value_range(self._id, lo, hi, cached=True)
+        for idx, v in values.iteritems():
+            yield (idx, v)
             
     def __modify_size(self, a):
-        s = int(self._infra._read_pid_value(self._id, self._index_hashmap_size)[1])
+        if self._mirror is not None:
+            self._mirror_size += a
+            return
+        if self._derived_size:
+            return
+        v = self._infra._read_pid_value(self._id, self._index_hashmap_size)
+        self.__set_size_strategy(v)
+        if self._derived_size:
+            return
+        s = int(v[1]) if v else 0
         s += a
         self._infra._write_pid_value(self._id, self._index_hashmap_size, VALUETYPE_HASHMAP_SIZE, s)
 
     def size(self):
-        return int(self._infra._read_pid_value(self._id, self._index_hashmap_size)[1])
+        if self._mirror is not None:
+            return self._mirror_size
+        v = self._infra._read_pid_value(self._id, self._index_hashmap_size)
+        self.__set_size_strategy(v)
+        if self._derived_size:
+            lo, hi = self._segment_bounds()
+            return len(self._infra._read_pid_value_range(self._id, lo, hi, cached=True))
+        if not v:
+            return 0
+        return int(v[1])
@@ -30,20 +30,32 @@ The views and conclusions contained in the software and documentation are those
 of the authors.
 '''
 import unittest
+from contextlib import contextmanager
 from lapis.infra.infrastructure import InMemoryInfrastructure, PIDAlreadyExistsError, PIDAliasBrokenError
 
 from random import Random
 
 import logging
 import os
+import shutil
+import pickle
+import json
+import tempfile
 from lapis.infra.handleinfrastructure import HandleInfrastructure
+from lapis.infra import handleinfrastructure
+from lapis.infra.cache import DiskRecordCache, SharedMemoryRecordCache
+from lapis.infra.sync import InfrastructureMirror
+from lapis.infra import registry
 
-from lapis.model.do import DigitalObject, PropertyNameMismatchError
+from lapis.model.do import DigitalObject, PropertyNameMismatchError, intern_pid, BASE_INDEX_PARENT_COUNT,\
+    VALUETYPE_PARENT_COUNT, VALUETYPE_PARENT_OBJECT, MAX_PARENTS, PAYLOAD_BITS, VALUETYPE_DERIVED_SIZE, INDEX_RESOURCE_TYPE
 
 from ConfigParser import ConfigParser
-from lapis.model.doset import DigitalObjectSet
+from lapis.model.doset import DigitalObjectSet, BASE_INDEX_MEMBER_FILTER
+from lapis.model.bloomfilter import BloomFilter
 from lapis.model.dolist import DigitalObjectArray, DigitalObjectLinkedList
-from lapis.model.hashmap import BASE_INDEX_HASHMAP_SIZE
+from lapis.model.hashmap import BASE_INDEX_HASHMAP_SIZE, BASE_INDEX_HASHMAP_VERSION, HASHMAP_VERSION_STABLE_HASH, HASHMASK,\
+    HASHMAP_VERSION_BUILTIN_HASH, HandleHashmapImpl, stable_hash, plan_bucket_positions
 
 TESTING_CONFIG_DEFAULTS = { "handle-prefix": "10876.test", "server-address": "handle8.dkrz.de", "server-port": 443 }
 
@@ -62,6 +74,23 @@ class TestDOInfrastructure(unittest.TestCase):
     def tearDown(self):
         pass
     
+    @contextmanager
+    def recorded_calls(self, method_name):
+        """
+        Records the positional arguments of all calls of the infrastructure method of given name while the context is 
+        active. The calls are passed on to the original method.
+        """
+        calls = []
+        method = getattr(self.do_infra, method_name)
+        def recording_method(*args, **kwargs):
+            calls.append(args)
+            return method(*args, **kwargs)
+        setattr(self.do_infra, method_name, recording_method)
+        try:
+            yield calls
+        finally:
+            delattr(self.do_infra, method_name)
+    
     def __check_dobj3_references(self, dobj3, dobj1, dobj2):
         i = 0
         iter3 = dobj3.iter_reference_keys()
@@ -139,6 +168,134 @@ class TestDOInfrastructure(unittest.TestCase):
         dobj = self.do_infra.lookup_pid(pid)
         assert dobj == None
         
+    def test_refresh(self):
+        pid = self.prefix+"test_refresh"
+        dobj = self.do_infra.create_do(pid)
+        self.created_pids.append(dobj.identifier)
+        dobj.resource_location = "http://www.example.com/refresh1"
+        dobj.set_property_value(20, "myproperty20", "a")
+        # property reads are served from the snapshot fetched on lookup
+        snap = self.do_infra.lookup_pid(dobj.identifier)
+        dobj.resource_location = "http://www.example.com/refresh2"
+        dobj.set_property_value(21, "myproperty21", "b")
+        assert snap.resource_location == "http://www.example.com/refresh1"
+        assert snap.is_property_assigned(21) == False
+        # own writes update the snapshot
+        snap.set_property_value(20, "myproperty20", "c")
+        assert snap.get_property_value(20) == ("myproperty20", "c")
+        snap.refresh()
+        assert snap.resource_location == "http://www.example.com/refresh2"
+        assert snap.get_property_value(21) == ("myproperty21", "b")
+        assert snap.get_property_value(20) == ("myproperty20", "c")
+        
+    def test_compact_instances(self):
+        pid = self.prefix+"test_compact"
+        pid2 = self.prefix+"test_compact_2"
+        dobj = self.do_infra.create_do(pid)
+        self.created_pids.append(dobj.identifier)
+        dobj2 = self.do_infra.create_do(pid2)
+        self.created_pids.append(dobj2.identifier)
+        assert not hasattr(dobj, "__dict__")
+        assert not hasattr(DigitalObjectSet(self.do_infra, pid), "__dict__")
+        # containers are only created when needed
+        assert dobj._references is None
+        assert list(dobj.iter_reference_keys()) == []
+        assert dobj.get_reference_pids("successor") == []
+        assert dobj.remove_do_references("successor") == False
+        dobj.add_do_reference("successor", dobj2)
+        assert dobj.get_reference_pids("successor") == [dobj2.identifier]
+        # identifiers are shared between instances
+        dobj3 = self.do_infra.lookup_pid(dobj.identifier)
+        assert dobj3.identifier is intern_pid("".join(dobj.identifier))
+        assert intern_pid(unicode(dobj.identifier)) is dobj3.identifier
+        assert intern_pid(u"10876.test/\xe4") == u"10876.test/\xe4"
+        assert dobj3.get_reference_pids("successor")[0] is dobj2.identifier
+        dobj3.release_snapshot()
+        assert dobj3.get_reference_pids("successor") == [dobj2.identifier]
+        
+    def test_properties_batch(self):
+        pid = self.prefix+"test_properties_batch"
+        dobj = self.do_infra.create_do(pid)
+        self.created_pids.append(dobj.identifier)
+        dobj.set_property_value(20, "myproperty20", "a")
+        dobj.set_properties({20: ("myproperty20", "b"), 21: ("myproperty21", 1), 22: ("myproperty22", "c")})
+        assert dobj.get_properties([20, 21, 23]) == {20: ("myproperty20", "b"), 21: ("myproperty21", "1")}
+        # a single mismatch prevents all writes
+        try:
+            dobj.set_properties({22: ("myproperty22", "d"), 21: ("otherproperty", "e")})
+        except PropertyNameMismatchError:
+            pass
+        else:
+            self.fail("PropertyNameMismatchError not raised")
+        dobj = self.do_infra.lookup_pid(dobj.identifier)
+        assert dobj.get_properties([20, 21, 22]) == {20: ("myproperty20", "b"), 21: ("myproperty21", "1"), 22: ("myproperty22", "c")}
+        
+    def test_handles(self):
+        pid = self.prefix+"test_handles"
+        dobj = self.do_infra.create_do(pid, DigitalObjectArray)
+        self.created_pids.append(dobj.identifier)
+        dobj.set_property_value(20, "myproperty20", "a")
+        dobj.add_do_reference("successor", dobj)
+        handle = pickle.loads(pickle.dumps(dobj.to_handle(), pickle.HIGHEST_PROTOCOL))
+        assert handle.identifier == dobj.identifier
+        dobj2 = handle.bind(self.do_infra)
+        assert isinstance(dobj2, DigitalObjectArray)
+        assert dobj2.infrastructure is self.do_infra
+        assert dobj2 == dobj
+        assert dobj2.get_property_value(20) == ("myproperty20", "a")
+        assert dobj2.get_reference_pids("successor") == [dobj.identifier]
+        assert dobj2.num_elements() == 0
+        
+    def test_edit_mode(self):
+        pid = self.prefix+"test_edit_mode"
+        pid2 = self.prefix+"test_edit_mode_2"
+        dobj = self.do_infra.create_do(pid)
+        self.created_pids.append(dobj.identifier)
+        dobj2 = self.do_infra.create_do(pid2)
+        self.created_pids.append(dobj2.identifier)
+        dobj.set_property_value(20, "myproperty20", "a")
+        dobj.set_property_value(21, "myproperty21", "b")
+        dobj.begin_edit()
+        assert dobj.editing
+        dobj.resource_location = "http://www.example.com/edit"
+        dobj.set_property_value(20, "myproperty20", "c")
+        dobj.remove_property_value(21)
+        dobj.add_do_reference("related", dobj2)
+        # nothing written yet
+        other = self.do_infra.lookup_pid(dobj.identifier)
+        assert other.resource_location == None
+        assert other.get_property_value(20) == ("myproperty20", "a")
+        assert other.get_reference_pids("related") == []
+        assert dobj.resource_location == "http://www.example.com/edit"
+        assert dobj.is_property_assigned(21) == False
+        dobj.save()
+        assert not dobj.editing
+        other = self.do_infra.lookup_pid(dobj.identifier)
+        assert other.resource_location == "http://www.example.com/edit"
+        assert other.get_property_value(20) == ("myproperty20", "c")
+        assert other.is_property_assigned(21) == False
+        assert other.get_reference_pids("related") == [dobj2.identifier]
+        # discarded edits are not written
+        other.begin_edit()
+        other.set_property_value(22, "myproperty22", "d")
+        other.discard_changes()
+        assert other.is_property_assigned(22) == False
+        assert self.do_infra.lookup_pid(dobj.identifier).is_property_assigned(22) == False
+        # reference edits on a looked-up instance are not written either
+        other = self.do_infra.lookup_pid(dobj.identifier)
+        other.begin_edit()
+        other.add_do_reference("related", dobj)
+        other.add_do_reference("successor", dobj2)
+        assert other.remove_do_references("related")
+        assert self.do_infra.lookup_pid(dobj.identifier).get_reference_pids("related") == [dobj2.identifier]
+        assert self.do_infra.lookup_pid(dobj.identifier).get_reference_pids("successor") == []
+        other.discard_changes()
+        assert other.get_reference_pids("related") == [dobj2.identifier]
+        assert list(other.iter_reference_keys()) == ["related"]
+        # removing the last reference removes the key
+        assert other.remove_do_reference("related", dobj2)
+        assert list(self.do_infra.lookup_pid(dobj.identifier).iter_reference_keys()) == []
+
     def test_infra_operations(self):
         dobj = self.do_infra.lookup_pid(self.prefix+"does-not-exist")
         assert dobj == None
@@ -213,6 +370,10 @@ class TestDOInfrastructure(unittest.TestCase):
             raise
         
     def test_sets(self):
+        # constructing collection instances does not access the infrastructure
+        DigitalObjectSet(self.do_infra, self.prefix+"does-not-exist")
+        DigitalObjectArray(self.do_infra, self.prefix+"does-not-exist")
+        DigitalObjectLinkedList(self.do_infra, self.prefix+"does-not-exist")
         # create a set
         id_ele = [self.prefix+"setele1", self.prefix+"setele2", self.prefix+"setele3"]
         id_set = self.prefix+"set"
@@ -281,6 +442,444 @@ class TestDOInfrastructure(unittest.TestCase):
             raise
         
         
+    def test_value_range(self):
+        dobj = self.do_infra.create_do(self.prefix+"test_value_range")
+        self.created_pids.append(dobj.identifier)
+        dobj.set_properties({20: ("myproperty20", "a"), 21: ("myproperty21", "b"), 30: ("myproperty30", "c")})
+        assert self.do_infra._read_pid_value_range(dobj.identifier, 20, 30) == {20: ("myproperty20", "a"), 21: ("myproperty21", "b")}
+        assert self.do_infra._read_pid_value_range(dobj.identifier, 22, 30) == {}
+        
+    def test_parent_slots(self):
+        ele = self.do_infra.create_do(self.prefix+"test_parent_slots_ele")
+        self.created_pids.append(ele.identifier)
+        sets = []
+        for i in range(4):
+            doset = self.do_infra.create_do(self.prefix+"test_parent_slots_set%s" % i, DigitalObjectSet)
+            self.created_pids.append(doset.identifier)
+            sets.append(doset)
+        csn = DigitalObjectSet.CHARACTERISTIC_SEGMENT_NUMBER
+        counter_index = BASE_INDEX_PARENT_COUNT+csn
+        with self.recorded_calls("_write_pid_values") as calls:
+            sets[0].add_do(ele)
+        # the first membership writes the counter along with the slot
+        assert [sorted(values) for identifier, values in calls if identifier == ele.identifier] == \
+            [[counter_index, ele._parent_segment_target_mask(sets[0])]]
+        sets[1].add_do(ele)
+        assert int(self.do_infra._read_pid_value(ele.identifier, counter_index)[1]) == 2
+        # records without counter are counted once, then get a counter
+        self.do_infra._remove_pid_value(ele.identifier, counter_index)
+        sets[2].add_do(ele)
+        assert int(self.do_infra._read_pid_value(ele.identifier, counter_index)[1]) == 3
+        assert ele.get_parent_pids(csn) == set([s.identifier for s in sets[:3]])
+        sets[1].remove_do(ele)
+        assert int(self.do_infra._read_pid_value(ele.identifier, counter_index)[1]) == 2
+        assert ele.get_parent_pids(csn) == set([sets[0].identifier, sets[2].identifier])
+        # removal moves the last slot into the hole
+        sets[1].add_do(ele)
+        with self.recorded_calls("_write_pid_values") as calls:
+            sets[0].remove_do(ele)
+        # moved slot and counter in a single request
+        assert [sorted(values) for identifier, values in calls if identifier == ele.identifier] == \
+            [[counter_index, ele._parent_segment_target_mask(sets[0])]]
+        assert self.do_infra._read_pid_value(ele.identifier, ele._parent_segment_target_mask(sets[0]))[1] == sets[1].identifier
+        assert self.do_infra._read_pid_value(ele.identifier, ele._parent_segment_target_mask(sets[0])+2) == None
+        assert ele.get_parent_pids(csn) == set([sets[1].identifier, sets[2].identifier])
+        sets[0].add_do(ele)
+        # no more slots
+        self.do_infra._write_pid_value(ele.identifier, counter_index, VALUETYPE_PARENT_COUNT, MAX_PARENTS)
+        self.assertRaises(Exception, sets[3].add_do, ele)
+        
+    def test_parent_slots_linked_list(self):
+        eles = []
+        for i in range(3):
+            ele = self.do_infra.create_do(self.prefix+"test_parent_slots_llele%s" % i)
+            self.created_pids.append(ele.identifier)
+            eles.append(ele)
+        list1 = self.do_infra.create_do(self.prefix+"test_parent_slots_list1", DigitalObjectLinkedList)
+        self.created_pids.append(list1.identifier)
+        list2 = self.do_infra.create_do(self.prefix+"test_parent_slots_list2", DigitalObjectLinkedList)
+        self.created_pids.append(list2.identifier)
+        # eles[0] occupies slot 0 in list1 and slots 1 and 2 in list2
+        list1.append_do(eles[0])
+        list1.append_do(eles[1])
+        list2.append_do(eles[2])
+        list2.append_do(eles[0])
+        list2.append_do(eles[0])
+        list2.append_do(eles[1])
+        # removing from list1 moves the last slot of eles[0] (the second occurrence in list2) to slot 0
+        list1.remove_do(eles[0])
+        assert eles[0].get_parent_pids(list1.CHARACTERISTIC_SEGMENT_NUMBER) == set([list2.identifier])
+        assert [list2.get_do(i).identifier for i in range(4)] == [eles[2].identifier, eles[0].identifier, eles[0].identifier, eles[1].identifier]
+        assert list2.last_element()[0].identifier == eles[1].identifier
+        assert list1.num_elements() == 1 and list1.get_do(0).identifier == eles[1].identifier
+        list2.remove_do(eles[1])
+        list2.remove_do(eles[2])
+        assert [list2.get_do(i).identifier for i in range(2)] == [eles[0].identifier, eles[0].identifier]
+        assert list2.first_element()[0].identifier == eles[0].identifier
+        assert list2.last_element()[0].identifier == eles[0].identifier
+        list2.remove_do(eles[0])
+        list2.remove_do(eles[0])
+        assert list2.num_elements() == 0
+        assert eles[0].get_parent_pids(list2.CHARACTERISTIC_SEGMENT_NUMBER) == set()
+        list2.append_do(eles[0])
+        assert list2.get_do(0).identifier == eles[0].identifier
+
+    def test_parent_slots_legacy_gaps(self):
+        ele = self.do_infra.create_do(self.prefix+"test_parent_gaps_ele")
+        self.created_pids.append(ele.identifier)
+        sets = []
+        for i in range(3):
+            doset = self.do_infra.create_do(self.prefix+"test_parent_gaps_set%s" % i, DigitalObjectSet)
+            self.created_pids.append(doset.identifier)
+            sets.append(doset)
+        csn = DigitalObjectSet.CHARACTERISTIC_SEGMENT_NUMBER
+        mask = ele._parent_segment_target_mask(sets[0])
+        # record written by an earlier version: slots 0 and 2 occupied, no counter
+        self.do_infra._write_pid_value(ele.identifier, mask, VALUETYPE_PARENT_OBJECT, sets[0].identifier)
+        self.do_infra._write_pid_value(ele.identifier, mask+2, VALUETYPE_PARENT_OBJECT, sets[1].identifier)
+        sets[2].add_do(ele)
+        assert int(self.do_infra._read_pid_value(ele.identifier, BASE_INDEX_PARENT_COUNT+csn)[1]) == 3
+        assert [self.do_infra._read_pid_value(ele.identifier, mask+i)[1] for i in range(3)] == [s.identifier for s in sets]
+        sets[0].remove_do(ele)
+        sets[1].remove_do(ele)
+        assert ele.get_parent_pids(csn) == set([sets[2].identifier])
+        assert self.do_infra._read_pid_value(ele.identifier, mask+1) == None
+        # linked lists move their element entries along
+        list1 = self.do_infra.create_do(self.prefix+"test_parent_gaps_list", DigitalObjectLinkedList)
+        self.created_pids.append(list1.identifier)
+        list1.append_do(ele)
+        list1.append_do(ele)
+        lmask = ele._parent_segment_target_mask(list1)
+        self.do_infra._write_pid_value(ele.identifier, lmask+3, VALUETYPE_PARENT_OBJECT, list1.identifier)
+        list1._member_slot_moved(ele, list1.identifier, 1, 3)
+        self.do_infra._remove_pid_values(ele.identifier, [lmask+1, BASE_INDEX_PARENT_COUNT+list1.CHARACTERISTIC_SEGMENT_NUMBER])
+        list1.append_do(ele)
+        assert int(self.do_infra._read_pid_value(ele.identifier, BASE_INDEX_PARENT_COUNT+list1.CHARACTERISTIC_SEGMENT_NUMBER)[1]) == 3
+        assert self.do_infra._read_pid_value(ele.identifier, lmask+3) == None
+        assert [list1.get_do(i).identifier for i in range(3)] == [ele.identifier] * 3
+        list1.remove_do(ele)
+        list1.remove_do(ele)
+        assert list1.num_elements() == 1 and list1.last_element()[0].identifier == ele.identifier
+
+    def test_derived_size(self):
+        self.assertRaises(ValueError, self.do_infra.set_collection_size_strategy, "unknown")
+        self.do_infra.set_collection_size_strategy("derived")
+        self.test_sets()
+        self.test_lists()
+        self.test_set_members_loaded()
+        doset = self.do_infra.lookup_pid(self.prefix+"test_set_loaded")
+        assert self.do_infra._read_pid_value(doset.identifier, BASE_INDEX_HASHMAP_SIZE+doset.CHARACTERISTIC_SEGMENT_NUMBER)[0] == VALUETYPE_DERIVED_SIZE
+        # arrays keep their counter
+        do_array = self.do_infra.lookup_pid(self.prefix+"array")
+        assert self.do_infra._read_pid_value(do_array.identifier, do_array.INDEX_ARRAY_SIZE)[0] == do_array.VALUETYPE_ARRAY_SIZE
+        
+    def test_set_initialize(self):
+        with self.recorded_calls("_write_pid_values") as calls:
+            doset = self.do_infra.create_do(self.prefix+"test_set_initialize", DigitalObjectSet)
+        self.created_pids.append(doset.identifier)
+        # resource type, hash map size and version in one request
+        assert [sorted(values) for identifier, values in calls] == [sorted([INDEX_RESOURCE_TYPE, BASE_INDEX_HASHMAP_SIZE+doset.CHARACTERISTIC_SEGMENT_NUMBER,
+                                  BASE_INDEX_HASHMAP_VERSION+doset.CHARACTERISTIC_SEGMENT_NUMBER])]
+        doset = self.do_infra.lookup_pid(doset.identifier)
+        assert isinstance(doset, DigitalObjectSet)
+        assert doset.num_set_elements() == 0
+        dobj = self.do_infra.create_do(self.prefix+"test_set_initialize_ele")
+        self.created_pids.append(dobj.identifier)
+        assert not doset.contains_do(dobj)
+        
+    def test_set_bulk(self):
+        doset = self.do_infra.create_do(self.prefix+"test_set_bulk", DigitalObjectSet)
+        self.created_pids.append(doset.identifier)
+        eles = []
+        for i in range(50):
+            ele = self.do_infra.create_do(self.prefix+"test_set_bulk_ele%s" % i)
+            self.created_pids.append(ele.identifier)
+            eles.append(ele)
+        with self.recorded_calls("_write_pid_values") as calls:
+            doset.add_do(eles[:30] + eles[:5])
+            doset.add_do(eles[20:50])
+        # buckets and size in one request each
+        assert [len(values) for identifier, values in calls if identifier == doset.identifier] == [31, 21]
+        assert doset.num_set_elements() == 50
+        for ele in eles:
+            assert ele.get_parent_pids(doset.CHARACTERISTIC_SEGMENT_NUMBER) == set([doset.identifier])
+        doset.remove_do(eles[10:40], workers=4)
+        assert doset.num_set_elements() == 20
+        assert doset.contains_do(eles[:10] + eles[40:])
+        for ele in eles[10:40]:
+            assert not doset.contains_do(ele)
+            assert ele.get_parent_pids(doset.CHARACTERISTIC_SEGMENT_NUMBER) == set()
+
+    def test_set_iteration(self):
+        doset = self.do_infra.create_do(self.prefix+"test_set_iteration", DigitalObjectSet)
+        self.created_pids.append(doset.identifier)
+        pids = set()
+        eles = []
+        for i in range(20):
+            ele = self.do_infra.create_do(self.prefix+"test_set_iteration_ele%s" % i)
+            self.created_pids.append(ele.identifier)
+            eles.append(ele)
+            pids.add(ele.identifier)
+        doset.add_do(eles)
+        with self.recorded_calls("lookup_pid") as lookups:
+            # identifiers only: no member is resolved
+            assert set(doset.iter_pids()) == pids
+            assert lookups == []
+            # prefetching never runs further ahead than the window
+            it = doset.iter_set_elements(prefetch=4, workers=3)
+            first = it.next()
+            assert len(lookups) <= 5
+            assert set([first.identifier] + [x.identifier for x in it]) == pids
+        assert sorted(identifier for identifier, in lookups) == sorted(pids)
+        assert set(x.identifier for x in doset.iter_set_elements(prefetch=64)) == pids
+        assert set(x.identifier for x in DigitalObjectSet.SetIterator(doset, iter(doset._DigitalObjectSet__hashmap))) == pids
+
+    def test_set_algebra(self):
+        seta = self.do_infra.create_do(self.prefix+"test_set_algebra_a", DigitalObjectSet)
+        self.created_pids.append(seta.identifier)
+        setb = self.do_infra.create_do(self.prefix+"test_set_algebra_b", DigitalObjectSet)
+        self.created_pids.append(setb.identifier)
+        eles = []
+        for i in range(10):
+            ele = self.do_infra.create_do(self.prefix+"test_set_algebra_ele%s" % i)
+            self.created_pids.append(ele.identifier)
+            eles.append(ele)
+        seta.add_do(eles[:6])
+        setb.add_do(eles[4:])
+        pids = [x.identifier for x in eles]
+        with self.recorded_calls("lookup_pid") as lookups:
+            assert seta.union(setb) == set(pids)
+            assert seta.intersection(setb) == set(pids[4:6])
+            assert seta.difference(setb) == set(pids[:4])
+            assert seta.difference(setb, pids[:2]) == set(pids[2:4])
+            assert not seta.is_subset(setb)
+            assert seta.is_subset(pids)
+        assert lookups == []
+        setc = DigitalObjectSet.materialize(self.do_infra, seta.difference(setb), self.prefix+"test_set_algebra_c")
+        self.created_pids.append(setc.identifier)
+        assert setc.num_set_elements() == 4
+        assert setc.is_subset(seta)
+        assert set(setc.iter_pids()) == set(pids[:4])
+        for ele in eles[:4]:
+            assert ele.get_parent_pids(setc.CHARACTERISTIC_SEGMENT_NUMBER) == set([seta.identifier, setc.identifier])
+        setd = DigitalObjectSet.materialize(self.do_infra, [])
+        self.created_pids.append(setd.identifier)
+        assert setd.num_set_elements() == 0
+
+    def test_set_membership_mask(self):
+        doset = self.do_infra.create_do(self.prefix+"test_set_mask", DigitalObjectSet)
+        self.created_pids.append(doset.identifier)
+        eles = []
+        for i in range(6):
+            ele = self.do_infra.create_do(self.prefix+"test_set_mask_ele%s" % i)
+            self.created_pids.append(ele.identifier)
+            eles.append(ele)
+        doset.add_do(eles[:3])
+        items = [eles[0], eles[4].identifier, eles[2].identifier, eles[5], self.prefix+"test_set_mask_unknown"]
+        with self.recorded_calls("_read_pid_value") as reads:
+            with self.recorded_calls("_read_pid_value_range") as range_reads:
+                assert doset.membership_mask(items) == [True, False, True, False, False]
+        assert len(reads) + len(range_reads) == 1
+        assert doset.membership_mask([]) == []
+        assert doset.contains_do(eles[:3])
+        assert not doset.contains_do(eles[2:4])
+        doset.load_members()
+        assert doset.membership_mask(eles) == [True, True, True, False, False, False]
+        doset.unload_members()
+        self.assertRaises(ValueError, doset.membership_mask, [eles[0], 1])
+
+    def test_set_member_filter(self):
+        bf = BloomFilter.for_capacity(100, 0.01)
+        for i in range(100):
+            bf.add("10876.test/bf%s" % i)
+        bf2 = BloomFilter.from_string(bf.to_string())
+        assert all(bf2.might_contain("10876.test/bf%s" % i) for i in range(100))
+        assert sum(1 for i in range(1000) if bf2.might_contain("10876.test/nobf%s" % i)) < 50
+        assert abs(bf.error_rate() - 0.01) < 0.005
+        self.assertRaises(ValueError, BloomFilter.from_string, "no filter")
+        doset = self.do_infra.create_do(self.prefix+"test_set_filter", DigitalObjectSet)
+        self.created_pids.append(doset.identifier)
+        eles = []
+        for i in range(12):
+            ele = self.do_infra.create_do(self.prefix+"test_set_filter_ele%s" % i)
+            self.created_pids.append(ele.identifier)
+            eles.append(ele)
+        # without a filter, answers are exact
+        doset.add_do(eles[:2])
+        assert not doset.has_member_filter()
+        assert doset.might_contain(eles[0])
+        assert not doset.might_contain(eles[5].identifier)
+        doset.enable_member_filter(capacity=8)
+        assert doset.has_member_filter()
+        doset.add_do(eles[2])
+        doset.add_do(eles[3:6])
+        filter_index = BASE_INDEX_MEMBER_FILTER+doset.CHARACTERISTIC_SEGMENT_NUMBER
+        # resolved sets know about the filter
+        doset = self.do_infra.lookup_pid(doset.identifier)
+        assert doset.has_member_filter()
+        for ele in eles[:6]:
+            assert doset.might_contain(ele)
+        # a negative answer costs one read
+        with self.recorded_calls("_read_pid_value") as reads:
+            negatives = [x for x in eles[6:] if not doset.might_contain(x.identifier)]
+        assert [index for identifier, index in reads] == [filter_index] * 6
+        assert negatives
+        # removals are counted and eventually cause a rebuild
+        doset.remove_do(eles[0])
+        bf = BloomFilter.from_string(self.do_infra._read_pid_value(doset.identifier, filter_index)[1])
+        assert (bf.count, bf.removed) == (6, 1)
+        doset.remove_do(eles[1:3])
+        bf = BloomFilter.from_string(self.do_infra._read_pid_value(doset.identifier, filter_index)[1])
+        assert (bf.count, bf.removed) == (3, 0)
+        # exceeding the capacity grows the filter
+        doset.add_do(eles[6:])
+        bf = BloomFilter.from_string(self.do_infra._read_pid_value(doset.identifier, filter_index)[1])
+        assert bf.count == 9 and bf.capacity >= 9
+        for ele in eles[3:]:
+            assert doset.might_contain(ele)
+        doset.disable_member_filter()
+        assert not doset.has_member_filter()
+        assert self.do_infra._read_pid_value(doset.identifier, filter_index) is None
+        assert not doset.might_contain(eles[0])
+
+    def test_set_members_loaded(self):
+        doset = self.do_infra.create_do(self.prefix+"test_set_loaded", DigitalObjectSet)
+        self.created_pids.append(doset.identifier)
+        eles = []
+        for i in range(5):
+            ele = self.do_infra.create_do(self.prefix+"test_set_loaded_ele%s" % i)
+            self.created_pids.append(ele.identifier)
+            eles.append(ele)
+        doset.add_do(eles[:2])
+        assert doset.contains_do(eles[:2])
+        doset.load_members()
+        doset.add_do(eles[2])
+        doset.remove_do(eles[0])
+        assert doset.num_set_elements() == 2
+        assert doset.contains_do(eles[2]) and not doset.contains_do(eles[0])
+        # not written yet
+        assert self.do_infra.lookup_pid(doset.identifier).num_set_elements() == 2
+        assert self.do_infra.lookup_pid(doset.identifier).contains_do(eles[0])
+        doset.unload_members()
+        doset2 = self.do_infra.lookup_pid(doset.identifier)
+        assert doset2.num_set_elements() == 2
+        assert doset2.contains_do([eles[1], eles[2]]) and not doset2.contains_do(eles[0])
+        assert set(x.identifier for x in doset2.iter_set_elements()) == set([eles[1].identifier, eles[2].identifier])
+        # buckets added and removed while loaded never reach the record
+        with self.recorded_calls("_remove_pid_values") as calls:
+            doset.load_members()
+            doset.add_do(eles[3])
+            doset.remove_do(eles[3])
+            doset.unload_members()
+            assert calls == []
+            # buckets written by an earlier flush are removed by a later one
+            doset.load_members()
+            doset.add_do(eles[4])
+            doset._DigitalObjectSet__hashmap.flush()
+            doset.remove_do(eles[4])
+            doset.unload_members()
+        assert sum(len(indices) for identifier, indices in calls) == 1
+        doset2 = self.do_infra.lookup_pid(doset.identifier)
+        assert doset2.num_set_elements() == 2
+        assert doset2.membership_mask(eles) == [False, True, True, False, False]
+        # buckets bulk-written to an empty loaded set are removed on unload
+        doset = self.do_infra.create_do(self.prefix+"test_set_loaded_bulk", DigitalObjectSet)
+        self.created_pids.append(doset.identifier)
+        doset.load_members()
+        doset.add_do(eles[:2])
+        doset.remove_do(eles[0])
+        doset.unload_members()
+        doset2 = self.do_infra.lookup_pid(doset.identifier)
+        assert doset2.num_set_elements() == 1
+        assert doset2.membership_mask(eles[:2]) == [False, True]
+        assert [x.identifier for x in doset2.iter_set_elements()] == [eles[1].identifier]
+        # changes of a failed flush are sent again by the next one
+        def failing_remove_pid_values(identifier, indices):
+            raise IOError("connection lost")
+        self.do_infra._remove_pid_values = failing_remove_pid_values
+        doset.load_members()
+        doset.add_do(eles[2])
+        doset.remove_do(eles[1])
+        self.assertRaises(IOError, doset.unload_members)
+        del self.do_infra._remove_pid_values
+        doset.unload_members()
+        doset2 = self.do_infra.lookup_pid(doset.identifier)
+        assert doset2.num_set_elements() == 1
+        assert doset2.membership_mask(eles[:3]) == [False, False, True]
+
+    def test_set_hash_versions(self):
+        doset = self.do_infra.create_do(self.prefix+"test_set_hash_versions", DigitalObjectSet)
+        self.created_pids.append(doset.identifier)
+        version_index = BASE_INDEX_HASHMAP_VERSION+doset.CHARACTERISTIC_SEGMENT_NUMBER
+        assert int(self.do_infra._read_pid_value(doset.identifier, version_index)[1]) == HASHMAP_VERSION_STABLE_HASH
+        # simulate a set written before the version marker was introduced
+        self.do_infra._remove_pid_value(doset.identifier, version_index)
+        doset = self.do_infra.lookup_pid(doset.identifier)
+        eles = []
+        for i in range(20):
+            ele = self.do_infra.create_do(self.prefix+"test_set_hash_versions_ele%s" % i)
+            self.created_pids.append(ele.identifier)
+            eles.append(ele)
+        doset.add_do(eles)
+        assert doset.contains_do(eles)
+        doset.rehash_members()
+        assert int(self.do_infra._read_pid_value(doset.identifier, version_index)[1]) == HASHMAP_VERSION_STABLE_HASH
+        doset = self.do_infra.lookup_pid(doset.identifier)
+        assert doset.num_set_elements() == 20
+        assert doset.contains_do(eles)
+        for ele in eles:
+            assert self.do_infra._read_pid_value(doset.identifier, (stable_hash(ele.identifier) & HASHMASK) + (doset.CHARACTERISTIC_SEGMENT_NUMBER << PAYLOAD_BITS))
+        stats = doset.probe_statistics()
+        assert stats["entries"] == 20 and stats["max"] == 1 and stats["mean"] == 1.0
+        
+    def test_hashmap_churn(self):
+        dobj = self.do_infra.create_do(self.prefix+"test_hashmap_churn")
+        self.created_pids.append(dobj.identifier)
+        for segment, version in ((5, HASHMAP_VERSION_STABLE_HASH), (6, HASHMAP_VERSION_BUILTIN_HASH)):
+            hm = HandleHashmapImpl(self.do_infra, dobj.identifier, segment)
+            hm.initialize()
+            hm._version = version
+            # force long collision chains, including wrap-around at the end of the segment
+            lo, hi = hm._segment_bounds()
+            hm._HandleHashmapImpl__prepare_hash = lambda key: lo + (hi - 3 - lo + int(key[1:]) % 7) % (hi - lo)
+            model = {}
+            for i in range(300):
+                key = "k%s" % self.random.randint(0, 40)
+                if self.random.random() < 0.6:
+                    hm.set(key, "v%s" % i)
+                    model[key] = "v%s" % i
+                else:
+                    hm.remove(key)
+                    model.pop(key, None)
+                assert hm.size() == len(model)
+            for i in range(41):
+                assert hm.get("k%s" % i) == model.get("k%s" % i)
+            assert sorted(v for idx, v in hm) == sorted(model.iteritems())
+        
+    def test_hashmap_bulk(self):
+        assert plan_bucket_positions([]) == []
+        assert plan_bucket_positions([3, 3, 4, 9, 9, 9, 10, 20]) == [3, 4, 5, 9, 10, 11, 12, 20]
+        dobj = self.do_infra.create_do(self.prefix+"test_hashmap_bulk")
+        self.created_pids.append(dobj.identifier)
+        hm = HandleHashmapImpl(self.do_infra, dobj.identifier, 5)
+        hm.initialize()
+        lo, hi = hm._segment_bounds()
+        hm._HandleHashmapImpl__prepare_hash = lambda key: lo + int(key[1:]) % 13
+        with self.recorded_calls("_write_pid_values") as calls:
+            hm.bulk_set([("k%s" % i, "v%s" % i) for i in range(100)] + [("k0", "v")], batch_size=40)
+        # three batches, the last one including the size
+        assert [len(values) for identifier, values in calls] == [40, 40, 21]
+        assert hm.size() == 100
+        assert hm.get("k0") == "v"
+        for i in range(1, 100):
+            assert hm.get("k%s" % i) == "v%s" % i
+        # non-empty hash maps are filled through the mirror
+        hm.bulk_set([("k%s" % i, "w%s" % i) for i in range(50, 150)])
+        assert hm.size() == 150
+        assert hm.get("k149") == "w149" and hm.get("k49") == "v49"
+        hm.remove("k3")
+        assert hm.get("k16") == "v16"
+        
     def test_lists(self):
         id_listele = [self.prefix+"listele1", self.prefix+"listele2", self.prefix+"listele3"]
         listele = []
@@ -449,6 +1048,306 @@ class TestHandleInfrastructure(TestDOInfrastructure):
         assert do.identifier.startswith(self.do_infra._prefix+"/"+self.do_infra._additional_identifier_element)
         
 
+class TestHandleReferenceChunks(unittest.TestCase):
+    """
+    Checks the reference layout of Handle records without a Handle server; raw value access is served from a dict.
+    """
+    
+    def setUp(self):
+        self.do_infra = HandleInfrastructure("localhost", 443, "user", "300", "password", "api/handles", prefix="10876.test")
+        self.values = {}
+        self.requests = []
+        self.do_infra._read_all_pid_values = lambda identifier: dict(self.values)
+        self.do_infra._write_pid_values = self.__write_pid_values
+        self.do_infra._remove_pid_values = self.__remove_pid_values
+        
+    def __write_pid_values(self, identifier, values):
+        self.requests.append(("PUT", sorted(values)))
+        self.values.update(values)
+        
+    def __remove_pid_values(self, identifier, indices):
+        if indices:
+            self.requests.append(("DELETE", sorted(indices)))
+        for index in indices:
+            del self.values[index]
+            
+    def __json_record(self):
+        # deliberately unordered
+        return {"values": [{"index": idx, "type": v[0], "data": {"format": "string", "value": v[1]}} 
+                           for idx, v in sorted(self.values.iteritems(), reverse=True)]}
+        
+    def test_chunks(self):
+        chunk_size = handleinfrastructure.REFERENCE_CHUNK_SIZE
+        pid = "10876.test/test_chunks"
+        refs = ["10876.test/ref%s" % i for i in range(chunk_size*2+1)]
+        self.values[1000] = ("other", json.dumps(["10876.test/other"]))
+        dobj = self.do_infra._do_from_json(self.__json_record(), pid, [])
+        for r in refs:
+            dobj.add_do_reference("derived-from", DigitalObject(self.do_infra, r))
+        # each append writes a single value, served from the snapshot
+        assert self.requests == [("PUT", [1001])]*chunk_size + [("PUT", [1002])]*chunk_size + [("PUT", [1003])]
+        assert len(json.loads(self.values[1003][1])) == 1
+        dobj = self.do_infra._do_from_json(self.__json_record(), pid, [])
+        assert dobj.get_reference_pids("derived-from") == refs
+        assert dobj.get_reference_pids("other") == ["10876.test/other"]
+        # rewriting the list drops obsolete chunks
+        self.requests = []
+        for r in refs[chunk_size:]:
+            dobj.remove_do_reference("derived-from", DigitalObject(self.do_infra, r))
+        assert self.requests[-2:] == [("PUT", [1001]), ("DELETE", [1002])]
+        dobj = self.do_infra._do_from_json(self.__json_record(), pid, [])
+        assert dobj.get_reference_pids("derived-from") == refs[:chunk_size]
+        dobj.remove_do_references("derived-from")
+        assert sorted(self.values) == [1000]
+        
+    def test_interleaved_keys(self):
+        chunk_size = handleinfrastructure.REFERENCE_CHUNK_SIZE
+        pid = "10876.test/test_interleaved_keys"
+        refs_a = ["10876.test/a%s" % i for i in range(chunk_size*2)]
+        self.values[1000] = ("a", json.dumps(refs_a[:chunk_size]))
+        self.values[1001] = ("b", json.dumps(["10876.test/b"]))
+        self.values[1002] = ("a", json.dumps(refs_a[chunk_size:]))
+        dobj = self.do_infra._do_from_json(self.__json_record(), pid, [])
+        dobj.remove_do_references("b")
+        # a new chunk is placed above the key's last chunk, not in the gap below it
+        dobj.add_do_reference("a", DigitalObject(self.do_infra, "10876.test/a_last"))
+        assert sorted(self.values) == [1000, 1002, 1003]
+        dobj = self.do_infra._do_from_json(self.__json_record(), pid, [])
+        assert dobj.get_reference_pids("a") == refs_a + ["10876.test/a_last"]
+        # rewriting the list keeps the chunk order as well
+        self.values[1001] = ("b", json.dumps(["10876.test/b"]))
+        dobj = self.do_infra._do_from_json(self.__json_record(), pid, [])
+        dobj.remove_do_reference("a", DigitalObject(self.do_infra, refs_a[0]))
+        dobj.add_do_reference("a", DigitalObject(self.do_infra, refs_a[0]))
+        refs = refs_a[1:] + ["10876.test/a_last", refs_a[0]]
+        dobj = self.do_infra._do_from_json(self.__json_record(), pid, [])
+        assert dobj.get_reference_pids("a") == refs
+        # without room above the last chunk, all chunks are placed anew in order
+        for idx in range(1004, handleinfrastructure.REFERENCE_INDEX_END+1):
+            self.values[idx] = ("c", json.dumps(["10876.test/c"]))
+        dobj = self.do_infra._do_from_json(self.__json_record(), pid, [])
+        dobj.remove_do_references("b")
+        for i in range(chunk_size):
+            refs.append("10876.test/a_more%s" % i)
+            dobj.add_do_reference("a", DigitalObject(self.do_infra, refs[-1]))
+        assert [idx for idx, v in sorted(self.values.iteritems()) if v[0] == "a"] == [1000, 1001, 1002, 1003]
+        dobj = self.do_infra._do_from_json(self.__json_record(), pid, [])
+        assert dobj.get_reference_pids("a") == refs
+        
+
+class TestInMemoryInfrastructure(unittest.TestCase):
+    
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.prefix = TESTING_CONFIG_DEFAULTS["handle-prefix"]+"/"
+        
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+        
+    def test_snapshot(self):
+        do_infra = InMemoryInfrastructure()
+        dobj = do_infra.create_do(self.prefix+"snapshot_ele")
+        dobj.resource_location = "http://www.example.com/snapshot"
+        dobj.set_property_value(20, "myproperty20", "abc")
+        doset = do_infra.create_do(self.prefix+"snapshot_set", DigitalObjectSet)
+        doset.add_do(dobj)
+        doset.add_do_reference("related", dobj)
+        do_infra.create_alias(dobj, self.prefix+"snapshot_alias")
+        path = os.path.join(self.tempdir, "infra.snapshot")
+        do_infra.save_snapshot(path)
+        # restore into a fresh instance
+        restored = InMemoryInfrastructure()
+        restored.load_snapshot(path)
+        dobj = restored.lookup_pid(self.prefix+"snapshot_alias")
+        assert dobj.identifier == self.prefix+"snapshot_ele"
+        assert dobj.resource_location == "http://www.example.com/snapshot"
+        assert dobj.get_property_value(20) == ("myproperty20", "abc")
+        doset = restored.lookup_pid(self.prefix+"snapshot_set")
+        assert isinstance(doset, DigitalObjectSet)
+        assert doset.contains_do(dobj)
+        assert doset.get_reference_pids("related") == [dobj.identifier]
+        # the restored state is independent of the original one
+        do_infra.delete_do(self.prefix+"snapshot_ele")
+        assert restored.lookup_pid(self.prefix+"snapshot_ele") != None
+        
+    def test_mirror(self):
+        source = InMemoryInfrastructure()
+        target = InMemoryInfrastructure()
+        dobj = source.create_do(self.prefix+"mirror_ele")
+        dobj.resource_location = "http://www.example.com/mirror"
+        doset = source.create_do(self.prefix+"mirror_set", DigitalObjectSet)
+        doset.add_do(dobj)
+        doset.add_do_reference("related", dobj)
+        source.create_alias(dobj, self.prefix+"mirror_alias")
+        ids = [self.prefix+"mirror_ele", self.prefix+"mirror_set", self.prefix+"mirror_alias"]
+        state_path = os.path.join(self.tempdir, "mirror.state")
+        stats = InfrastructureMirror(source, target, state_path).sync(ids)
+        assert stats == {"copied": 3, "unchanged": 0, "deleted": 0, "skipped": 0, "failed": 0}
+        assert target.is_alias(self.prefix+"mirror_alias")
+        dobj = target.lookup_pid(self.prefix+"mirror_alias")
+        assert dobj.resource_location == "http://www.example.com/mirror"
+        doset = target.lookup_pid(self.prefix+"mirror_set")
+        assert isinstance(doset, DigitalObjectSet)
+        assert doset.contains_do(dobj)
+        assert dobj.get_parent_pids(doset.CHARACTERISTIC_SEGMENT_NUMBER) == set([doset.identifier])
+        # references are copied although the in-memory infrastructure keeps them outside of the raw values
+        assert doset.get_reference_pids("related") == [dobj.identifier]
+        # only changed records are copied again; reference changes count as changes
+        source.lookup_pid(self.prefix+"mirror_ele").resource_location = "http://www.example.com/mirror2"
+        stats = InfrastructureMirror(source, target, state_path).sync(ids + [self.prefix+"mirror_missing"])
+        assert stats == {"copied": 1, "unchanged": 2, "deleted": 0, "skipped": 1, "failed": 0}
+        assert target.lookup_pid(self.prefix+"mirror_ele").resource_location == "http://www.example.com/mirror2"
+        source.lookup_pid(self.prefix+"mirror_set").remove_do_reference("related", self.prefix+"mirror_ele")
+        source.lookup_pid(self.prefix+"mirror_set").add_do_reference("successor", self.prefix+"mirror_ele")
+        stats = InfrastructureMirror(source, target, state_path).sync(ids)
+        assert stats == {"copied": 1, "unchanged": 2, "deleted": 0, "skipped": 0, "failed": 0}
+        doset = target.lookup_pid(self.prefix+"mirror_set")
+        assert list(doset.iter_reference_keys()) == ["successor"]
+        assert doset.get_reference_pids("successor") == [self.prefix+"mirror_ele"]
+        # records deleted at the source are deleted from the target
+        source.delete_alias(self.prefix+"mirror_alias")
+        source.delete_do(self.prefix+"mirror_set")
+        stats = InfrastructureMirror(source, target, state_path).sync(ids)
+        assert stats == {"copied": 0, "unchanged": 1, "deleted": 2, "skipped": 0, "failed": 0}
+        assert target.lookup_pid(self.prefix+"mirror_set") == None
+        assert target.lookup_pid(self.prefix+"mirror_ele") != None
+        self.assertRaises(KeyError, target.is_alias, self.prefix+"mirror_alias")
+        
+
+class TestRecordCache(unittest.TestCase):
+    
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+    
+    def test_disk_cache(self):
+        path = os.path.join(self.tempdir, "records.db")
+        cache = DiskRecordCache(path, ttl=60, max_entries=3)
+        assert cache.get("10876.test/a") == None
+        cache.put("10876.test/a", '{"values": []}')
+        assert cache.get("10876.test/a") == '{"values": []}'
+        # a second instance on the same file sees the same records
+        assert DiskRecordCache(path).get("10876.test/a") == '{"values": []}'
+        cache.invalidate("10876.test/a")
+        assert cache.get("10876.test/a") == None
+        # eviction of the oldest records
+        for i in range(5):
+            cache.put("10876.test/%s" % i, "%s" % i)
+        assert cache.get("10876.test/0") == None
+        assert cache.get("10876.test/1") == None
+        assert cache.get("10876.test/4") == "4"
+        # expiry
+        cache = DiskRecordCache(path, ttl=-1)
+        assert cache.get("10876.test/4") == None
+        
+    def test_shared_memory_cache(self):
+        path = os.path.join(self.tempdir, "records.shm")
+        cache = SharedMemoryRecordCache(path, ttl=60, slots=16, slot_size=128)
+        assert cache.get("10876.test/a") == None
+        cache.put("10876.test/a", '{"values": []}')
+        assert cache.get("10876.test/a") == '{"values": []}'
+        # a second mapping of the same file sees the same records and keeps the existing layout
+        other = SharedMemoryRecordCache(path, slots=1024)
+        assert other.get("10876.test/a") == '{"values": []}'
+        other.invalidate("10876.test/a")
+        assert cache.get("10876.test/a") == None
+        # records too large for a slot are not cached
+        cache.put("10876.test/b", "x" * 200)
+        assert cache.get("10876.test/b") == None
+        cache.put("10876.test/c", "c")
+        cache.clear()
+        assert cache.get("10876.test/c") == None
+        other.close()
+        cache.close()
+
+    def test_handle_cache_use(self):
+        class Response(object):
+            def __init__(self, data):
+                self.status = 200
+                self.reason = "OK"
+                self.data = data
+        class ConnectionPool(object):
+            def __init__(self):
+                self.requests = []
+                self.values = [{"index": 1, "type": "URL", "data": {"format": "string", "value": "http://www.example.com/1"}}]
+            def request(self, method, path, body, headers):
+                self.requests.append(method)
+                return Response(json.dumps({"values": self.values}))
+            def urlopen(self, method, path, body, headers):
+                self.requests.append(method)
+                return Response("")
+        do_infra = HandleInfrastructure("localhost", 443, "user", "300", "password", "api/handles", prefix="10876.test")
+        pool = ConnectionPool()
+        do_infra._HandleInfrastructure__connpool = pool
+        do_infra.set_record_cache(DiskRecordCache(os.path.join(self.tempdir, "records.db"), ttl=60))
+        pid = "10876.test/cached"
+        assert do_infra.lookup_pid(pid).resource_location == "http://www.example.com/1"
+        assert do_infra.lookup_pid(pid).resource_location == "http://www.example.com/1"
+        assert pool.requests == ["GET"]
+        # raw reads always go to the server
+        do_infra._read_all_pid_values(pid)
+        do_infra._read_all_pid_values(pid)
+        assert pool.requests == ["GET"] * 3
+        # writes invalidate the cached record
+        pool.values[0]["data"]["value"] = "http://www.example.com/2"
+        do_infra._write_pid_value(pid, 20, "myproperty20", "a")
+        assert do_infra.lookup_pid(pid).resource_location == "http://www.example.com/2"
+        assert pool.requests == ["GET"] * 3 + ["PUT", "GET"]
+        do_infra._remove_pid_values(pid, [20])
+        do_infra.lookup_pid(pid)
+        assert pool.requests == ["GET"] * 3 + ["PUT", "GET", "DELETE", "GET"]
+        # read-only range reads share the cached record, reads for modifications do not
+        pool.requests = []
+        assert do_infra._read_pid_value_range(pid, 1, 2, cached=True) == {1: ("URL", "http://www.example.com/2")}
+        assert do_infra._read_pid_value_range(pid, 1, 2) == {1: ("URL", "http://www.example.com/2")}
+        assert pool.requests == ["GET"]
+        do_infra._record_cache.clear()
+        do_infra._read_pid_value_range(pid, 1, 2, cached=True)
+        do_infra.lookup_pid(pid)
+        assert pool.requests == ["GET"] * 2
+
+
+class TestBackendRegistry(unittest.TestCase):
+    
+    def test_connect(self):
+        do_infra = registry.connect({"lapis": {"backend": "memory"}})
+        assert isinstance(do_infra, InMemoryInfrastructure)
+        do_infra = registry.connect({"server": {"host": "handle.example.com", "port": 8443, "user": "admin", "password": "secret"},
+                                  "handle": {"prefix": "10876.test"}})
+        assert isinstance(do_infra, HandleInfrastructure)
+        assert do_infra._host == "handle.example.com"
+        assert do_infra._port == 8443
+        assert do_infra._prefix == "10876.test"
+        # enough open connections for the default number of workers
+        assert do_infra._HandleInfrastructure__connpool.pool.maxsize == handleinfrastructure.DEFAULT_CONNECTIONS
+        do_infra = registry.connect({"server": {"host": "handle.example.com", "connections": 32}, "handle": {"prefix": "10876.test"}})
+        assert do_infra._HandleInfrastructure__connpool.pool.maxsize == 32
+        # values are not interpolated
+        do_infra = registry.connect({"server": {"host": "handle.example.com", "password": "100%secret"}, "handle": {"prefix": "10876.test"}})
+        assert isinstance(do_infra, HandleInfrastructure)
+        config_path = os.path.join(tempfile.mkdtemp(), "lapis.cfg")
+        with open(config_path, "w") as f:
+            f.write("[lapis]\nbackend = memory\nsize_strategy = derived\n[extra]\nurl = http://www.example.com/a%20b\n")
+        try:
+            assert registry.load_config(config_path).get("extra", "url") == "http://www.example.com/a%20b"
+            assert isinstance(registry.connect(config_path), InMemoryInfrastructure)
+        finally:
+            shutil.rmtree(os.path.dirname(config_path))
+        try:
+            registry.connect({"lapis": {"backend": "does-not-exist"}})
+            self.fail("Connected to unknown backend!")
+        except KeyError:
+            pass
+        
+    def test_register_backend(self):
+        class CustomInfrastructure(InMemoryInfrastructure):
+            pass
+        registry.register_backend("custom", CustomInfrastructure)
+        assert isinstance(registry.connect({"lapis": {"backend": "custom"}}), CustomInfrastructure)
+        
+
 class TestPIDRegExp(unittest.TestCase):
     
     def test_pids(self):
@@ -26,7 +26,11 @@ setup(name='lapis',
       include_package_data=True,
       zip_safe=False,
       install_requires=requires,
+      extras_require={"bulk": ["numpy"]},
       entry_points="""
       # -*- Entry points: -*-
+      [lapis.backends]
+      memory = lapis.infra.infrastructure:InMemoryInfrastructure
+      handle = lapis.infra.handleinfrastructure:HandleInfrastructure
       """,
       )